@@ -0,0 +1,85 @@
+# benchmark.py
+# PURPOSE : To time every stage of the flow path engine on synthetic basins of fixed
+#           sizes, so regressions and engine changes can be measured on any Linux box
+# Inputs  : basin sizes (cells) and assessment unit counts; python benchmark.py --help
+# OUTPUTS : benchmark/<cells>_<units>.jsonl per case, benchmark/benchmark.json with the
+#           throughput (cells per second) and resident memory peak of every stage
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+from flowengine import OUTPUTS, flow_paths
+from instrument import Profiler, read_records
+from localbackend import LocalBackend
+from synthetic import save_basin, synthetic_basin
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5] # cells per basin (up to 10 ** 8 with --sizes)
+UNITS = [1, 10] # assessment units per basin
+
+
+def run_case(nCells, nUnits, outFolder, seed=0, processes=1, outputs=None):
+    # one synthetic basin through flowengine.flow_paths on the local backend, every stage
+    # from reading the features to the requested outputs (default flowengine.OUTPUTS; []
+    # for the tables only, which large basins need); returns the profiles (one per unit
+    # worker as well with processes > 1). Memory is the per-stage peak RSS the profiler
+    # records, so the timed run is not slowed down by allocation tracing.
+    caseName = "{}_{}".format(nCells, nUnits)
+    basinFolder = outFolder + "/basin_" + caseName
+    if not os.path.exists(basinFolder + "/basin.json"):
+        save_basin(synthetic_basin(nCells, nUnits, seed), basinFolder)
+    resultsPath = outFolder + "/results_" + caseName
+    if os.path.exists(resultsPath):
+        shutil.rmtree(resultsPath) # a manifest from the previous run would skip the basin
+    for stalePath in glob.glob(outFolder + "/" + caseName + ".*.jsonl"):
+        os.remove(stalePath)
+    profiler = Profiler(outFolder + "/" + caseName + ".jsonl", size=nCells, units=nUnits)
+    flow_paths(caseName, LocalBackend(basinFolder), resultsPath, outputs=outputs, profiler=profiler, processes=processes)
+    return [profiler.outPath] + sorted(glob.glob(outFolder + "/" + caseName + ".*.jsonl"))
+
+
+def report(profilePaths, outPath):
+    # per case and stage: total wall time, cells per second and the largest RSS peak
+    cases = {}
+    for record in read_records(profilePaths):
+        key = "{}_{}".format(record["size"], record["units"])
+        summary = cases.setdefault(key, {}).setdefault(record["stage"], {"wall": 0.0, "cells": 0, "peak_rss": 0})
+        summary["wall"] += record["wall"]
+        summary["cells"] += record.get("cells", 0)
+        summary["peak_rss"] = max(summary["peak_rss"], record.get("peak_rss") or 0)
+    for stages in cases.values():
+        for summary in stages.values():
+            summary["cells_per_s"] = summary["cells"] / summary["wall"] if summary["wall"] > 0 else None
+    with open(outPath, "w") as f:
+        json.dump(cases, f, indent=1, sort_keys=True)
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flow path engine benchmark on synthetic basins")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="basin sizes in cells")
+    parser.add_argument("--units", type=int, nargs="+", default=UNITS, help="assessment units per basin")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=1, help="unit worker processes per basin")
+    parser.add_argument("--outputs", nargs="*", default=OUTPUTS,
+                        help="outputs per unit besides the tables (none: tables only, for large sizes)")
+    parser.add_argument("--out", default="benchmark", help="output folder")
+    args = parser.parse_args()
+
+    profilePaths = []
+    for nCells in args.sizes:
+        for nUnits in args.units:
+            start = time.time()
+            profilePaths += run_case(nCells, nUnits, args.out, args.seed, args.processes, args.outputs)
+            print("{} cells, {} units: {:.1f} s".format(nCells, nUnits, time.time() - start))
+    cases = report(profilePaths, args.out + "/benchmark.json")
+    for key in sorted(cases, key=lambda key: [int(part) for part in key.split("_")]):
+        for name, summary in sorted(cases[key].items(), key=lambda item: -item[1]["wall"]):
+            print("{:>14} {:<16} {:8.3f} s {:>12} cells/s {:>12} bytes".format(
+                key, name, summary["wall"], "{:.0f}".format(summary["cells_per_s"] or 0), summary["peak_rss"]))
+
+
+if __name__ == "__main__":
+    main()
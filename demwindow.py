@@ -0,0 +1,99 @@
+# demwindow.py
+# PURPOSE : To read basin windows of the continental DEM without clipping it to a new
+#           raster, keeping recently used tiles in memory for neighbouring basins
+# Inputs  : a DEM grid and a block reader (arcpy, or a memory-mapped .npy on Linux)
+# OUTPUTS : float64 DEM window (NoData as NaN) and its GridSpec
+
+import collections
+import math
+import numpy
+from rasterize import GridSpec
+
+
+class TileCache(object):
+    # Least recently used tiles, evicted once the cached bytes exceed the budget
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.tiles = collections.OrderedDict()
+
+    def get(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is not None:
+            self.tiles[key] = tile # most recently used goes last
+        return tile
+
+    def put(self, key, tile):
+        old = self.tiles.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.tiles[key] = tile
+        self.nbytes += tile.nbytes
+        while self.nbytes > self.maxBytes and len(self.tiles) > 1:
+            evicted = self.tiles.popitem(last=False)[1]
+            self.nbytes -= evicted.nbytes
+
+
+class DemSource(object):
+    # A DEM read in fixed tiles aligned to its own grid. readBlock(row, col, nrows, ncols)
+    # returns the raw cells of a block that lies inside the DEM.
+
+    def __init__(self, grid, readBlock, nodata=None, tileSize=1024, cacheBytes=512 * 1024 * 1024):
+        self.grid = grid
+        self.readBlock = readBlock
+        self.nodata = nodata
+        self.tileSize = tileSize
+        self.cache = TileCache(cacheBytes)
+
+    def tile(self, tileRow, tileCol):
+        key = (tileRow, tileCol)
+        tile = self.cache.get(key)
+        if tile is None:
+            row0, col0 = tileRow * self.tileSize, tileCol * self.tileSize
+            nrows = min(self.tileSize, self.grid.nrows - row0)
+            ncols = min(self.tileSize, self.grid.ncols - col0)
+            tile = numpy.asarray(self.readBlock(row0, col0, nrows, ncols), dtype=numpy.float64)
+            if self.nodata is not None:
+                tile = numpy.where(tile == self.nodata, numpy.nan, tile)
+            self.cache.put(key, tile)
+        return tile
+
+    def read(self, row0, col0, nrows, ncols):
+        # cells [row0, row0 + nrows) x [col0, col0 + ncols); cells outside the DEM are NaN
+        out = numpy.full((nrows, ncols), numpy.nan)
+        r0, r1 = max(row0, 0), min(row0 + nrows, self.grid.nrows)
+        c0, c1 = max(col0, 0), min(col0 + ncols, self.grid.ncols)
+        if r1 <= r0 or c1 <= c0:
+            return out
+        for tileRow in range(r0 // self.tileSize, (r1 - 1) // self.tileSize + 1):
+            for tileCol in range(c0 // self.tileSize, (c1 - 1) // self.tileSize + 1):
+                tile = self.tile(tileRow, tileCol)
+                tr0, tc0 = tileRow * self.tileSize, tileCol * self.tileSize
+                ra, rb = max(r0, tr0), min(r1, tr0 + tile.shape[0])
+                ca, cb = max(c0, tc0), min(c1, tc0 + tile.shape[1])
+                out[ra - row0:rb - row0, ca - col0:cb - col0] = tile[ra - tr0:rb - tr0, ca - tc0:cb - tc0]
+        return out
+
+    def window_grid(self, xmin, ymin, xmax, ymax, halo=0.0):
+        # DEM row/column and GridSpec of the rectangle grown by the halo, snapped to the
+        # DEM grid, without reading it
+        cellSize = self.grid.cellSize
+        col0 = int(math.floor((xmin - halo - self.grid.xmin) / cellSize))
+        col1 = int(math.ceil((xmax + halo - self.grid.xmin) / cellSize))
+        row0 = int(math.floor((self.grid.ymax - (ymax + halo)) / cellSize))
+        row1 = int(math.ceil((self.grid.ymax - (ymin - halo)) / cellSize))
+        nrows, ncols = max(row1 - row0, 1), max(col1 - col0, 1)
+        grid = GridSpec(self.grid.xmin + col0 * cellSize, self.grid.ymax - row0 * cellSize, cellSize, nrows, ncols)
+        return row0, col0, grid
+
+    def window(self, xmin, ymin, xmax, ymax, halo=0.0):
+        # DEM cells covering the rectangle grown by the halo, snapped to the DEM grid
+        row0, col0, grid = self.window_grid(xmin, ymin, xmax, ymax, halo)
+        return self.read(row0, col0, grid.nrows, grid.ncols), grid
+
+
+def npy_dem(path, grid, nodata=None, **kwargs):
+    # DEM stored as a .npy array, memory-mapped so only the tiles read are paged in
+    array = numpy.load(path, mmap_mode="r")
+    return DemSource(grid, lambda row, col, nrows, ncols: array[row:row + nrows, col:col + ncols], nodata, **kwargs)
@@ -0,0 +1,366 @@
+# flowengine.py
+# PURPOSE : To run the flow path analysis of one basin on arrays held in memory (in
+#           tiles through tiledengine when they would not fit), with all reading and
+#           writing done by a backend (flowpaths.ArcpyBackend on ArcGIS,
+#           localbackend.LocalBackend anywhere NumPy runs)
+# Inputs  : a backend for the basin (features, DEM window, output writers)
+# OUTPUTS : requested per-unit outputs through the backend, unit tables as column
+#           batches, the run manifest and the basin profile
+
+import collections
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy
+from rasterize import bounding_window, polyline_cells, polygon_mask, window_cells
+from zonalstats import group_mean, join_column, path_mean_std, zonal_table
+from pathdistance import path_distance, BACKLINK_NODATA
+from flowtree import backlink_parents, path_length, path_root
+from flowgroups import group_cells, group_parts, group_paths
+from pathstore import column_table, trace_paths
+from surfacelength import surface_length
+from slope import slope_cost
+from instrument import NullProfiler, open_profiler
+from manifest import basin_is_current, content_hash, load_manifest, new_manifest, record_unit, save_manifest, unit_is_current
+from resultwriter import remove_batches, write_batch
+import tiledengine
+
+VERTICAL_FACTOR = "LINEAR 2 -90 90 -0.022222" # path distance vertical factor
+SLOPE_CLASSES = 10 # number of slope cost classes
+SLOPE_BREAKS = "EQUAL_INTERVAL" # or "QUANTILE"
+PIPELINE_VERSION = 2 # bump when a change should invalidate completed units
+PARAMETERS = {"version": PIPELINE_VERSION, "verticalFactor": VERTICAL_FACTOR,
+              "slopeClasses": SLOPE_CLASSES, "slopeBreaks": SLOPE_BREAKS}
+PROFILE = True # per-stage JSON lines in results/profile; False costs nothing
+# Final outputs written per assessment unit. Everything else stays in memory and is
+# released when the unit (or basin) is done; add "PathDist", "BackLink" or "FlowTree"
+# to keep those rasters/arrays as well.
+OUTPUTS = ["CostPath", "MajorFlowPathGroups"]
+# Working memory of one basin run, its unit workers included (flowpaths.run_basins
+# shares it among the basins running at once). Basins whose arrays and cost path store
+# would not fit (tiledengine.in_memory_bytes) run out of core in tiles (tiledengine),
+# with the basin arrays memory-mapped in a scratch folder.
+MEMORY_BUDGET = 4 * 1024 ** 3
+# Assessment units of one (in-memory) basin run across up to this many processes, as
+# many as the memory budget holds; the basin arrays are shared read-only as
+# memory-mapped files in a scratch folder
+UNIT_PROCESSES = 1
+# Local folder for the scratch folders of memory-mapped basin arrays (None: the system
+# temp folder); not the results folder, which may be on network storage
+SCRATCH_FOLDER = None
+BASIN_ARRAYS = ["dem", "slope", "reclass", "source", "pointid"]
+TABLES = ["CostPath_ZonalStats", "MajorFlowPathGroup_ZonalStats"] # unit tables, as column batches
+WORKER = {} # per unit worker process: its backend, shared basin arrays and profiler
+
+
+def basin_arrays(features, demArray, grid, profiler):
+    # Basin level arrays every assessment unit reads: the cost surface (Horn slope in
+    # degrees reclassified into SLOPE_CLASSES classes within the basin), the stream link
+    # source cells and the pointid each DEM cell would get from RasterToPoint
+    basinMask = numpy.zeros(demArray.shape, dtype=bool)
+    for rings in features["basin"]:
+        basinMask |= polygon_mask(rings, grid)
+    slopeArray, reclassArray, slopeBreaks = slope_cost(demArray, grid.cellSize, SLOPE_CLASSES, SLOPE_BREAKS, basinMask)
+    print('Upper class break values:')
+    print(slopeBreaks) # new upper class limits for each slope raster
+    profiler.done("slope_reclass", cells=demArray.size)
+
+    streamCells = polyline_cells(features["streams"], grid)[1]
+    streamSource = numpy.zeros(demArray.shape, dtype=bool)
+    streamSource.ravel()[streamCells] = True
+    demData = numpy.isfinite(demArray).ravel()
+    pointID = numpy.where(demData, numpy.cumsum(demData), 0)
+    profiler.done("stream_sources", cells=len(streamCells))
+    return {"dem": demArray, "grid": grid, "slope": slopeArray, "reclass": reclassArray,
+            "source": streamSource, "pointid": pointID}
+
+
+def run_unit(GRID, assessID, rings, basin, backend, resultsPath, outputs, profiler):
+    # One assessment unit from path distance to its tables. Every intermediate is local
+    # to this call and released when it returns; only the requested outputs are written.
+    # Returns the paths written.
+    written = []
+
+    # UNIT WINDOW: the unit's bounding box plus one cell (the bilinear corners of its edge
+    # cells) cut from the basin arrays. Path distance never leaves the unit mask and only
+    # the stream cells inside it are sources, so everything below runs on the window and
+    # gives the results of the whole basin grid; cell indices map back with window_cells.
+    basinGrid = basin["grid"]
+    rows, cols, unitGrid = bounding_window([ring for featureRings in rings for ring in featureRings], basinGrid, 1)
+    demArray = numpy.asarray(basin["dem"][rows, cols])
+    slopeArray = numpy.asarray(basin["slope"][rows, cols])
+    pointID = basin["pointid"].reshape(basinGrid.nrows, basinGrid.ncols)[rows, cols].ravel()
+    unitMask = numpy.zeros(demArray.shape, dtype=bool)
+    for featureRings in rings:
+        unitMask |= polygon_mask(featureRings, unitGrid)
+
+    # PATH DISTANCE: from the stream links over the reclassified slope, with the DEM as
+    # surface and vertical raster, limited to the assessment unit (was env.mask)
+    pathDist, backLink = path_distance(basin["source"][rows, cols], basin["reclass"][rows, cols], demArray,
+                                       unitGrid.cellSize, VERTICAL_FACTOR, mask=unitMask)
+    if "PathDist" in outputs:
+        written.append(backend.write_raster(resultsPath + "/PathDist_" + assessID, pathDist, unitGrid))
+    if "BackLink" in outputs:
+        written.append(backend.write_raster(resultsPath + "/BackLink_" + assessID, backLink, unitGrid, BACKLINK_NODATA))
+    profiler.done("path_distance", cells=int(unitMask.sum()), created=len(written))
+
+    # COST PATH: follow the backlinks of all cells at once as a flow tree (parent cell
+    # per cell); path length, cost and endpoint come from the tree, not from polylines
+    flowTree = backlink_parents(backLink)
+    if "FlowTree" in outputs:
+        # window cells with their basin cell index; parent and root as basin cell indices
+        outFlowTree = resultsPath + "/FlowTree_" + assessID + ".npz"
+        root = path_root(flowTree)
+        numpy.savez_compressed(outFlowTree, cell=window_cells(numpy.arange(len(flowTree)), rows, cols, basinGrid),
+                               parent=numpy.where(flowTree >= 0, window_cells(flowTree, rows, cols, basinGrid), flowTree),
+                               pointid=pointID, pathcost=pathDist.ravel(), length=path_length(flowTree),
+                               root=numpy.where(root >= 0, window_cells(root, rows, cols, basinGrid), root))
+        written.append(outFlowTree)
+    profiler.done("flow_tree", cells=int((flowTree >= 0).sum()), created=int("FlowTree" in outputs))
+
+    # MAJOR FLOW PATH GROUPS: paths ending in the same stream cell form a group, keyed
+    # on the end cell index (MFPGID numbered in cell order)
+    mfpgID, groupEnds = group_paths(flowTree)
+
+    # COST PATH ATTRIBUTES: one cost path per cell with a path (EACH_CELL, in cell
+    # order); every attribute is a sum down the flow tree, so no path is expanded
+    starts = numpy.flatnonzero(flowTree >= 0)
+    columns = collections.OrderedDict()
+    columns["DestID"] = pointID[starts]
+    columns["PathCost"] = pathDist.ravel()[starts]
+    columns["MFPGID"] = mfpgID[starts]
+
+    # SURFACE LENGTH: 3D length of every backlink step from the bilinear DEM surface,
+    # summed down the flow tree (was AddSurfaceInformation_3d SURFACE_LENGTH BILINEAR
+    # over every polyline)
+    columns["SLength"] = surface_length(flowTree, demArray, unitGrid.cellSize)[starts]
+    profiler.done("surface_length", cells=len(starts), features=len(starts))
+
+    # ZONAL STATISTICS: mean and std dev Slope and Elevation over the cells of every
+    # cost path, from count, sum and sum of squares down the tree
+    for prefix, raster in [("SLOPE", slopeArray), ("DEM", demArray)]:
+        mean, std = path_mean_std(flowTree, raster)
+        columns[prefix + "_M"], columns[prefix + "_SD"] = mean[starts], std[starts]
+
+    # Major Flow Path Groups: a group covers the cells of all its cost paths; the
+    # average shape length of a group's cost paths is joined in memory
+    mfpgLabels, mfpgCells = group_cells(mfpgID, groupEnds)
+    zsTableMFPG = zonal_table(mfpgLabels, mfpgCells, [("SLOPE", slopeArray), ("DEM", demArray)], "MFPGID")
+    lengthGroups, lengthMean = group_mean(columns["MFPGID"], columns["SLength"])
+    nparrMFPG = join_column(zsTableMFPG, "MFPGID", "SLength", lengthGroups, lengthMean)
+    profiler.done("zonal_stats", cells=len(starts) + len(mfpgCells), features=len(starts) + len(zsTableMFPG))
+
+    # export cost path polylines (traced into a path store only here) and the dissolved
+    # group lines with all their fields, each in one write
+    exported = len(written)
+    if "CostPath" in outputs:
+        paths = trace_paths(flowTree, starts, columns)
+        profiler.done("trace_paths", cells=len(paths.cells), features=len(paths))
+        written.append(backend.write_cost_paths(resultsPath + "/CostPath_" + assessID, [paths], unitGrid))
+    if "MajorFlowPathGroups" in outputs:
+        written.append(backend.write_flow_path_groups(resultsPath + "/MajorFlowPathGroups_assess_" + assessID,
+                                                      sorted(group_parts(flowTree, mfpgID).items()), unitGrid,
+                                                      nparrMFPG))
+    profiler.done("export_paths", features=len(starts) + len(groupEnds), created=len(written) - exported)
+
+    # unit tables as binary column batches partitioned by basin (GRID, the basin_id key
+    # of the partition index) and unit, one file each, replaced on rerun
+    nparrCP = column_table(columns, ["PathCost", "DestID", "SLength", "MFPGID", "SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD"], "FID")
+    tablesPath = resultsPath + "/tables"
+    written.append(write_batch(tablesPath, "CostPath_ZonalStats", GRID, assessID, nparrCP))
+    written.append(write_batch(tablesPath, "MajorFlowPathGroup_ZonalStats", GRID, assessID, nparrMFPG))
+    profiler.done("tables", features=len(nparrCP) + len(nparrMFPG), created=2)
+    return written
+
+
+def scratch_folder(GRID):
+    # a new local scratch folder for one basin, removed by whoever uses it
+    return tempfile.mkdtemp(prefix="scratch_" + GRID + "_", dir=SCRATCH_FOLDER)
+
+
+def remove_unit(GRID, assessID, outputs, backend, resultsPath):
+    # outputs and table batches of a unit the basin no longer has, so merged results
+    # only hold the units of the current inputs
+    tablesPath = resultsPath + "/tables"
+    for table in TABLES:
+        remove_batches(tablesPath, table, GRID, assessID)
+    for output in outputs:
+        if output.startswith(tablesPath):
+            continue
+        if output.endswith(".npz"): # flow tree arrays, written here rather than by the backend
+            if os.path.exists(output):
+                os.remove(output)
+        else:
+            backend.delete_output(output)
+
+
+def share_basin(basin, folder):
+    # The basin arrays as .npy files for the unit workers to map read-only, so the pages
+    # are held once by the OS for all workers instead of being copied into each
+    for name in BASIN_ARRAYS:
+        numpy.save(folder + "/" + name + ".npy", basin[name])
+    return folder
+
+
+def open_shared_basin(folder, grid):
+    basin = dict((name, numpy.load(folder + "/" + name + ".npy", mmap_mode="r")) for name in BASIN_ARRAYS)
+    basin["grid"] = grid
+    return basin
+
+
+def init_unit_worker(backend, basinFolder, grid, profileClass, profilePath, context):
+    # each worker writes its own profile, <GRID>.<pid>.jsonl next to the basin profile
+    WORKER["backend"] = backend
+    WORKER["basin"] = open_shared_basin(basinFolder, grid)
+    if profilePath is None:
+        WORKER["profiler"] = NullProfiler()
+    else:
+        WORKER["profiler"] = profileClass(profilePath[:-len(".jsonl")] + ".{}.jsonl".format(os.getpid()), **context)
+
+
+def unit_worker(task):
+    GRID, assessID, rings, resultsPath, outputs = task
+    profiler = WORKER["profiler"]
+    profiler.context["assess_id"] = assessID
+    profiler.mark()
+    return run_unit(GRID, assessID, rings, WORKER["basin"], WORKER["backend"], resultsPath, outputs, profiler)
+
+
+def run_units(GRID, units, basin, backend, resultsPath, outputs, profiler, processes):
+    # Run (assessID, rings) units across a process pool sharing the basin arrays and yield
+    # (assessID, written) in unit order, so the manifest and outputs do not depend on which
+    # worker finished first
+    shareFolder = share_basin(basin, scratch_folder(GRID))
+    profilePath = getattr(profiler, "outPath", None)
+    context = dict((name, value) for name, value in profiler.context.items() if name != "assess_id")
+    pool = multiprocessing.Pool(processes, init_unit_worker,
+                                (backend, shareFolder, basin["grid"], type(profiler), profilePath, context))
+    try:
+        tasks = [(GRID, assessID, rings, resultsPath, outputs) for assessID, rings in units]
+        for (assessID, rings), written in zip(units, pool.imap(unit_worker, tasks)):
+            yield assessID, written
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(shareFolder, ignore_errors=True)
+
+
+def run_sequential(GRID, assessID, rings, basin, backend, resultsPath, outputs, profiler, tiled):
+    # one unit in this process, in memory or in tiles
+    profiler.context["assess_id"] = assessID
+    if tiled:
+        return tiledengine.run_unit(GRID, assessID, rings, basin, backend, resultsPath, outputs, VERTICAL_FACTOR,
+                                    profiler)
+    return run_unit(GRID, assessID, rings, basin, backend, resultsPath, outputs, profiler)
+
+
+def flow_paths(GRID, backend, resultsPath, outputs=None, profiler=None, processes=None, memoryBudget=None):
+    # Flow paths and major flow path groups of every assessment unit of one basin
+    # (profiler: to record the stages somewhere other than results/profile; processes:
+    # unit workers, UNIT_PROCESSES by default; memoryBudget: MEMORY_BUDGET by default)
+    outputs = OUTPUTS if outputs is None else outputs
+    processes = UNIT_PROCESSES if processes is None else processes
+    memoryBudget = MEMORY_BUDGET if memoryBudget is None else memoryBudget
+    if memoryBudget <= 0:
+        raise ValueError("The memory budget of basin {} is {} bytes; it has to be positive".format(GRID, memoryBudget))
+    if not os.path.exists(resultsPath):
+        os.makedirs(resultsPath)
+
+    # Run manifest: skip the basin if its features, DEM, parameters and requested outputs
+    # are unchanged and every unit finished; otherwise units that are still current are
+    # skipped one by one
+    manifestPath = resultsPath + "/manifest/" + GRID + ".json"
+    basinHash = content_hash(backend.input_hash(), PARAMETERS, sorted(outputs))
+    previous = load_manifest(manifestPath)
+    if basin_is_current(previous, basinHash):
+        print("Basin {} is up to date".format(GRID))
+        return
+    manifest = new_manifest(GRID, basinHash)
+    if profiler is None:
+        for stalePath in glob.glob(resultsPath + "/profile/" + GRID + ".*.jsonl"):
+            os.remove(stalePath) # unit worker profiles of the previous run
+        profiler = open_profiler(resultsPath + "/profile/" + GRID + ".jsonl", PROFILE, GRID=GRID)
+    profiler.mark()
+
+    # Part 1: this basin's features (basin polygons, assessment units, stream links) in
+    # memory, read by the backend without any intermediate feature classes
+    features = backend.features()
+    profiler.done("read_features", features=len(features["basin"]) + len(features["units"]) + len(features["streams"]))
+
+    # DEM WINDOW: the basin extent +/- 5 meter, read once; the same array feeds slope,
+    # path distance, surface length and the statistics
+    XminExtent, YminExtent, XmaxExtent, YmaxExtent = features["extent"]
+    print("Basin extent: {} {} {} {}".format(XminExtent, YminExtent, XmaxExtent, YmaxExtent))
+    dem = backend.dem_source()
+    row0, col0, basinGrid = dem.window_grid(XminExtent, YminExtent, XmaxExtent, YmaxExtent, 5)
+    tiled = tiledengine.needs_tiles(basinGrid, memoryBudget, outputs)
+    if tiled:
+        # Part 2 (tiled): DEM window, cost surface and stream sources as scratch files
+        # read one tile at a time; the unit tables, cost path and group lines are written
+        unsupported = [output for output in outputs if output not in tiledengine.TILED_OUTPUTS]
+        if unsupported:
+            print("WARNING: basin {} ({} cells) does not fit {} bytes in memory; tiled basins cannot write {}, "
+                  "which are skipped".format(GRID, basinGrid.nrows * basinGrid.ncols, memoryBudget, unsupported))
+            outputs = [output for output in outputs if output in tiledengine.TILED_OUTPUTS]
+        print("Basin {} runs in tiles of {} cells".format(GRID, tiledengine.tile_size(memoryBudget) ** 2))
+        basin = tiledengine.TiledBasin(features, dem, row0, col0, basinGrid, scratch_folder(GRID),
+                                       memoryBudget, SLOPE_CLASSES, SLOPE_BREAKS, profiler)
+        manifest["demHash"] = basin.demHash
+    else:
+        demArray = dem.read(row0, col0, basinGrid.nrows, basinGrid.ncols)
+        manifest["demHash"] = content_hash(demArray)
+        profiler.done("dem_window", cells=demArray.size)
+
+        # Part 2: cost surface and stream sources shared by every assessment unit
+        basin = basin_arrays(features, demArray, basinGrid, profiler)
+
+    # units of the previous run that the basin no longer has
+    unitIDs = set(str(assessID) for assessID, rings in features["units"])
+    for assessID, unit in sorted((previous or {}).get("units", {}).items()):
+        if assessID not in unitIDs:
+            print("Assessment unit {} was removed from the basin".format(assessID))
+            remove_unit(GRID, assessID, unit["outputs"], backend, resultsPath)
+
+    # Part 3: least cost paths and major flow path groups for each assessment unit
+    comparable = dict(PARAMETERS, outputs=sorted(outputs))
+    pending = []
+    unitHashes = {}
+    for assessID, rings in features["units"]:
+        # skip the unit if it finished before with the same inputs
+        unitHash = content_hash(features["hash"], manifest["demHash"], [assessID, rings], comparable)
+        if unit_is_current(previous, assessID, unitHash):
+            record_unit(manifest, assessID, unitHash, previous["units"][str(assessID)]["outputs"])
+            print("Assessment unit {} is up to date".format(assessID))
+            profiler.context["assess_id"] = assessID
+            profiler.done("unit_skipped")
+            continue
+        pending.append((assessID, rings))
+        unitHashes[assessID] = unitHash
+
+    # Units run one after another in this process, or across a pool of unit workers
+    # (not for tiled basins, whose unit state is one set of scratch files, nor inside a
+    # daemonic worker, which cannot start processes of its own), as many as the budget
+    # holds
+    fitting = int(memoryBudget // tiledengine.in_memory_bytes(basinGrid, outputs))
+    processes = min(processes, len(pending), max(1, fitting))
+    parallel = processes > 1 and not tiled and not multiprocessing.current_process().daemon
+    try:
+        if parallel:
+            results = run_units(GRID, pending, basin, backend, resultsPath, outputs, profiler, processes)
+        else:
+            results = ((assessID, run_sequential(GRID, assessID, rings, basin, backend, resultsPath, outputs,
+                                                 profiler, tiled))
+                       for assessID, rings in pending)
+        for assessID, written in results:
+            # checkpoint: the unit is complete once all of its outputs are written
+            record_unit(manifest, assessID, unitHashes[assessID], written)
+            save_manifest(manifest, manifestPath)
+    finally:
+        if tiled:
+            basin.close()
+
+    profiler.context.pop("assess_id", None)
+    manifest["complete"] = True
+    save_manifest(manifest, manifestPath)
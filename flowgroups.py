@@ -0,0 +1,54 @@
+# flowgroups.py
+# PURPOSE : To group flow paths that end in the same stream cell into major flow path
+#           groups and build each group's dissolved geometry from the flow tree
+# Inputs  : parent index per cell from flowtree.backlink_parents
+# OUTPUTS : MFPGID per cell, group end cells, dissolved polyline parts per group
+
+import numpy
+from flowtree import path_root
+
+
+def group_paths(parent):
+    # MFPGID of every cell with a path (-1 otherwise): groups are keyed on the integer
+    # index of the end cell and numbered in cell order; also returns each group's end cell
+    hasPath = parent >= 0
+    mfpgID = numpy.full(len(parent), -1, dtype=numpy.int64)
+    groupEnds, inverse = numpy.unique(path_root(parent)[hasPath], return_inverse=True)
+    mfpgID[hasPath] = inverse
+    return mfpgID, groupEnds
+
+
+def group_cells(mfpgID, groupEnds):
+    # (MFPGID, cell) pairs covering every group: its path cells plus its end cell
+    cells = numpy.flatnonzero(mfpgID >= 0)
+    labels = numpy.concatenate([mfpgID[cells], numpy.arange(len(groupEnds))])
+    return labels, numpy.concatenate([cells, groupEnds])
+
+
+def group_parts(parent, mfpgID):
+    # Dissolved lines of every group as {MFPGID: [cell chains]}. The union of a group's
+    # paths is a subtree; each chain runs from a leaf (a cell no path passes through)
+    # down to the first cell already covered, so every tree edge is drawn once.
+    hasPath = parent >= 0
+    children = numpy.bincount(parent[hasPath], minlength=len(parent))
+    leaves = numpy.flatnonzero(hasPath & (children == 0))
+    return trace_chains(leaves.tolist(), mfpgID[leaves].tolist(), parent.tolist(), [False] * len(parent), {})
+
+
+def trace_chains(leaves, groups, parent, covered, parts):
+    # The chain of every leaf (in order) into parts[group], marking its cells in covered.
+    # parent and covered only need indexing: lists, or memoryviews over scratch arrays
+    # when the tree is too large to hold (tiledengine).
+    for leaf, group in zip(leaves, groups):
+        chain = [leaf]
+        covered[leaf] = True
+        cell = parent[leaf]
+        while cell >= 0:
+            chain.append(cell)
+            if covered[cell]:
+                break
+            covered[cell] = True
+            cell = parent[cell]
+        parts.setdefault(group, []).append(chain)
+    return parts
+
@@ -13,371 +13,284 @@ import time
 import os
 import shutil
 import csv
+import glob
+import multiprocessing
+import concurrent.futures
+import traceback
 import numpy
-import pandas as pd
 from arcpy import env
 from arcpy.sa import *
-
-def flow_paths(inBF, inAU, inSL, inRaster):
-
-    # Work directory
-    inPath = os.path.dirname(os.path.realpath(inBF))
-    newPath = inPath.replace(os.sep, '/')
-    gdbPath = newPath + "/results/flowpaths.gdb"
-    mergePath = newPath + "/results/flowpathsMerge.gdb"
-    # Environment Settings
-    env.workspace = inPath
-    env.overwriteOutput=True
-    arcpy.env.outputCoordinateSystem = arcpy.SpatialReference("North America Albers Equal Area Conic")
-    arcpy.env.geographicTransformations = "WGS_1984_To_NAD_1983"
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.CheckOutExtension("3D")
-
-    # Part 1: Select data needed for the analysis and export to workspace, create basin DEM rasters
-    # SELECT LAYER BY ATTRIBUTE AND COPY FEATURES (basin)
-    inBFfl = arcpy.management.MakeFeatureLayer(inBF, "inBFfl")
-    selectOutput_BF = gdbPath + "/BF_" + GRID # output basin feature class
-    arcpy.management.SelectLayerByAttribute(inBFfl, "NEW_SELECTION", "\"gridcode\" = {}".format(GRID))
-    arcpy.CopyFeatures_management(inBFfl, selectOutput_BF)
-
-    # SELECT LAYER BY ATTRIBUTE AND COPY FEATURES (assessment unit)
-    inAUfl = arcpy.management.MakeFeatureLayer(inAU, "inAUfl")
-    selectOutput_AU = gdbPath + "/AU_" + GRID
-    arcpy.management.SelectLayerByAttribute(inAUfl, "NEW_SELECTION", "\"basin_id\" = {}".format(GRID))
-    arcpy.CopyFeatures_management(inAUfl, selectOutput_AU)
-
-    # SELECT LAYER BY ATTRIBUTE AND COPY FEATURES (stream link)
-    inSLfl = arcpy.management.MakeFeatureLayer(inSL, "inSLfl")
-    selectOutput_SL = gdbPath + "/SL_" + GRID
-    arcpy.management.SelectLayerByAttribute(inSLfl, "NEW_SELECTION", "\"basin_id\" = {}".format(GRID))
-    arcpy.CopyFeatures_management(inSLfl, selectOutput_SL)
-
-    # Clear Selection (ensure all selections are cleared)
-    arcpy.SelectLayerByAttribute_management(inBFfl, "CLEAR_SELECTION", "\"GRID\" = \"\"")
-    arcpy.SelectLayerByAttribute_management(inAUfl, "CLEAR_SELECTION", "\"basin_id\" = \"\"")
-    arcpy.SelectLayerByAttribute_management(inSLfl, "CLEAR_SELECTION", "\"basin_id\" = \"\"")
-
-    # ADD FIELD and CALCULATE FIELD (assessment units)
-    fieldName_assess = "AU_char"
-    fieldType_assess = "TEXT"
-    fieldValue = "!assess_id!"
-    arcpy.AddField_management(selectOutput_AU, fieldName_assess, fieldType_assess, "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-    arcpy.CalculateField_management(selectOutput_AU, fieldName_assess, fieldValue, "PYTHON_9.3")
-
-    # SPLIT (assessment units)
-    outWorkspace = gdbPath
-    arcpy.Split_analysis(selectOutput_AU, selectOutput_AU, fieldName_assess, outWorkspace, "")
-    arcpy.management.Delete(selectOutput_AU)
-
-    # ADD GEOMETRY ATTRIBUTES: Add extent to basin attribute table to reduce processing time.
-    basinExtent = selectOutput_BF
-    arcpy.AddGeometryAttributes_management(basinExtent, "EXTENT", "", "", "")
-    print("Basin extent: " + basinExtent)
-
-    # SEARCH CURSOR: X Min
-    Xmin = "EXT_MIN_X"
-    num = [row[0] for row in arcpy.da.SearchCursor(basinExtent, Xmin)]
-    XminExtent = str(num)[1:-1]
-
-    # SEARCH CURSOR: Y Min
-    Xmax = "EXT_MAX_X"
-    num = [row[0] for row in arcpy.da.SearchCursor(basinExtent, Xmax)]
-    XmaxExtent = str(num)[1:-1]
-
-    # SEARCH CURSOR: X Max
-    Ymin = "EXT_MIN_Y"
-    num = [row[0] for row in arcpy.da.SearchCursor(basinExtent, Ymin)]
-    YminExtent = str(num)[1:-1]
-
-    # SEARCH CURSOR: Y Max
-    Ymax = "EXT_MAX_Y"
-    num = [row[0] for row in arcpy.da.SearchCursor(basinExtent, Ymax)]
-    YmaxExtent = str(num)[1:-1]
-
-    env.workspace = gdbPath
-
-    # CLIP: Clip raster to extent of basin +/- 5 meter.
-    clipRaster = gdbPath + "/ClipDEM_" + GRID
-    Xmin = float(XminExtent) - 5
-    Ymin = float(YminExtent) - 5
-    Xmax = float(XmaxExtent) + 5
-    Ymax = float(YmaxExtent) + 5
-    rectangle = str(Xmin) + " " + str(Ymin) + " " + str(Xmax) + " " + str(Ymax)
-    arcpy.management.Clip(inRaster, rectangle, clipRaster, basinExtent, "-9999", "#", "MAINTAIN_EXTENT")
-
-    # Part 2: Create slope rasters, reclassify them, and create destination point layers for each basin
-    arcpy.env.mask = selectOutput_BF + ".shp"
-
-    # gather basin ID associated with each input basin
-    gridcodeField = "gridcode"
-    gridcodeNum = [row[0] for row in arcpy.da.SearchCursor(selectOutput_BF, gridcodeField)]
-    gridcode = str(gridcodeNum)[1:-1]
-
-    # SLOPE
-    basinDEM = clipRaster
-    outSlope = gdbPath + "/Slope" + GRID
-    arcpy.gp.Slope_sa(basinDEM, outSlope, "DEGREE", "1")
-
-    # Reclass Variables: Equal Interval classification scheme
-    minSlopeValue = arcpy.GetRasterProperties_management(outSlope, "MINIMUM")
-    minSlope = float(minSlopeValue.getOutput(0))
-    maxSlopeValue = arcpy.GetRasterProperties_management(outSlope, "MAXIMUM")
-    maxSlope = float(maxSlopeValue.getOutput(0))
-    classSize = (maxSlope - minSlope) / 10
-    c1 = minSlope + classSize # upper class limit of first class
-    c2 = c1 + classSize
-    c3 = c2 + classSize
-    c4 = c3 + classSize
-    c5 = c4 + classSize
-    c6 = c5 + classSize
-    c7 = c6 + classSize
-    c8 = c7 + classSize
-    c9 = c8 + classSize
-    c10 = c9 + classSize # upper class limit of 10th class
-    print('Upper class break values:')
-    print(c1, c2, c3, c4, c5, c6, c7, c8, c9, c10) # new upper class limits for each slope raster
-    reclass = RemapValue([[minSlope, c1, 1],[c1, c2, 2],[c2, c3, 3],[c3, c4, 4],[c4, c5, 5],[c5, c6, 6],[c6, c7, 7],[c7, c8, 8],[c8, c9, 9], [c9, c10, 10]])
-
-    # RECLASSIFY
-    outReclass = gdbPath + "/Reclass_" + GRID
-    reclassField = "Value"
-    slopeReclass = Reclassify(outSlope, reclassField, reclass)
-    slopeReclass.save(outReclass)
-
-    # RASTER TO POINT
-    inRaster = clipRaster
-    outSourcePoint = gdbPath + "/SourcePoint_" + GRID
-    arcpy.RasterToPoint_conversion(inRaster, outSourcePoint, "Value")
-
-    # Part 3: Create least cost path polylines for each assessment unit, identify major flow paths
-    env.workspace = gdbPath
-
-    # Local Variables
-    auName =  "T*"
-    assessUnits = arcpy.ListFeatureClasses(auName)
-
-    for assessUnit in assessUnits:
-        arcpy.env.mask = assessUnit
-
-        # gather assess ID associated with each input assessment unit
-        assessField = "assess_id"
-        assessNum = [row[0] for row in arcpy.da.SearchCursor(assessUnit, assessField)]
-        assessID = str(assessNum)[1:-1] # used to identify inputs for Path Distance tool
-
-        # gather basin ID associated with each input assessment unit
-        basinField = "basin_id"
-        basinNum = [row[0] for row in arcpy.da.SearchCursor(assessUnit, basinField)]
-        basinID = str(basinNum)[1:-1] # used to identify inputs for Path Distance tool
-
-        # PATH DISTANCE
-        inStreamlink = selectOutput_SL
-        inSlope = gdbPath + "/Reclass_" + GRID
-        inDEM = clipRaster
-        outPathDist = resultsPath + "/PathDist_" + assessID + ".tif"
-        outBackLink = resultsPath + "/BackLink_" + assessID + ".tif"
-        arcpy.gp.PathDistance_sa(inStreamlink, outPathDist, inSlope, inDEM, "", "TABLE ", inDEM, "LINEAR 2 -90 90 -0.022222", "", outBackLink, "", "", "", "", "")
-
-        # COST PATH AS POLYLINE
-        outCostPath = resultsPath + "/CostPath_" + assessID
-        # sourcePoint = gdbPath + "/SourcePoint_" + GRID
-        arcpy.gp.CostPathAsPolyline_sa(outSourcePoint, outPathDist, outBackLink, outCostPath, "EACH_CELL", "pointid")
-
-        # ADD SURFACE INFORMATION: calculates surface distance of flow paths
-        inCostPath = outCostPath + ".shp"
-        arcpy.AddSurfaceInformation_3d(inCostPath, clipRaster, "SURFACE_LENGTH", "BILINEAR", "", "1", "0", "NO_FILTER")
-
-        # ADD GEOMETRY ATTRIBUTES
-        fieldNameX = "END_X_char"
-        fieldNameY = "END_Y_char"
-        fieldName = "JoinField"
-        fieldTypeSTR = "TEXT"
-        fieldTypeINT = "LONG"
-        fieldValue = "!END_X_char!" + "!END_Y_char!"
-        arcpy.AddGeometryAttributes_management(inCostPath, "LINE_START_MID_END", "", "", "")
-        arcpy.AddField_management(inCostPath, fieldNameX, fieldTypeSTR, "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        arcpy.AddField_management(inCostPath, fieldNameY, fieldTypeSTR, "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        arcpy.AddField_management(inCostPath, fieldName, fieldTypeSTR, "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        arcpy.CalculateField_management(inCostPath, fieldNameX, "!END_X!", "PYTHON_9.3")
-        arcpy.CalculateField_management(inCostPath, fieldNameY, "!END_Y!", "PYTHON_9.3")
-        arcpy.CalculateField_management(inCostPath, fieldName, fieldValue, "PYTHON_9.3")
-        # arcpy.CalculateField_management(inCostPath, "DestID", "!FID!", "PYTHON_9.3")
-
-        # DISSOlVE
-        outMajorFlowPathGroups = resultsPath + "/MajorFlowPathGroups_assess_" + assessID
-        arcpy.Dissolve_management(inCostPath, outMajorFlowPathGroups, fieldName, "", "MULTI_PART", "DISSOLVE_LINES")
-
-        # ADD FIELD
-        inMajorFlowPathGroups = outMajorFlowPathGroups + ".shp"
-        fieldNameID = "MFPGID" # i.e., MajorFlowPathGroupID
-        fieldValueID = "!FID!"
-        arcpy.AddField_management(inMajorFlowPathGroups, fieldNameID, fieldTypeINT, "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        arcpy.CalculateField_management(inMajorFlowPathGroups, fieldNameID, fieldValueID, "PYTHON_9.3")
-
-        # JOIN FIELD
-        inCostPath = outCostPath + ".shp"
-        arcpy.JoinField_management(inCostPath, fieldName, inMajorFlowPathGroups, fieldName, fieldNameID)
-
-        # Delete unecessary fields
-        deleteFields = ["START_X", "START_Y", "MID_X", "MID_Y", "END_X", "END_Y", "END_X_char", "END_Y_char", "JoinField"]
-        arcpy.DeleteField_management(inCostPath, deleteFields)
-        arcpy.DeleteField_management(inMajorFlowPathGroups, "JoinField")
-
-        # get number of polylines in each cost path feature class
-        # resultCP = arcpy.GetCount_management(inCostPath)
-        # countCP = int(resultCP.getOutput(0))
-        # print(countCP)
-
-        cpValues = [row[0] for row in arcpy.da.SearchCursor(inCostPath, "DestID")]
-        sliceobject = slice(1)
-        cpValues[sliceobject]
-        minCP = min(cpValues)
-        print minCP
-
-        # calculate mean and std dev Slope and Elevation values for each cost path polyline
-        # for num in range(1,countCP + 1):
-        for cp in cpValues[:10]:
-            inCPfl = arcpy.management.MakeFeatureLayer(inCostPath, "inCPfl")
-            selectOutput_CP = mergePath + "/CP_" + str(cp)
-            arcpy.management.SelectLayerByAttribute(inCPfl, "NEW_SELECTION", "\"DestID\" = {}".format(cp))
-            arcpy.CopyFeatures_management(inCPfl, selectOutput_CP)
-            outTableSlope = mergePath + "/SlopeZS" + str(cp)
-            arcpy.gp.ZonalStatisticsAsTable(selectOutput_CP, "DestID", outSlope, outTableSlope, "DATA", "MEAN_STD")
-            arcpy.AlterField_management(outTableSlope, "MEAN", "SLOPE_M")
-            arcpy.AlterField_management(outTableSlope, "STD", "SLOPE_SD")
-            outTableDEM = mergePath + "/ElevationZS" + str(cp)
-            arcpy.gp.ZonalStatisticsAsTable(selectOutput_CP, "DestID", inDEM, outTableDEM, "DATA", "MEAN_STD")
-            arcpy.AlterField_management(outTableDEM, "MEAN", "DEM_M")
-            arcpy.AlterField_management(outTableDEM, "STD", "DEM_SD")
-            arcpy.SelectLayerByAttribute_management(inCPfl, "CLEAR_SELECTION", "\"DestID\" = \"\"")
-            arcpy.JoinField_management(outTableSlope, "DestID", outTableDEM, "DestID", ["DEM_M", "DEM_SD"])
-            outTableZS = mergePath + "/ZS" + str(cp)
-            arcpy.Rename_management(outTableSlope, outTableZS)
-            arcpy.management.Delete(outTableDEM)
-            arcpy.management.Delete(outTableDEM) # for stubborn files
-            arcpy.management.Delete(selectOutput_CP)
-            arcpy.management.Delete(selectOutput_CP)
-
-        # Local Variables
-        zsName =  "ZS*"
-        env.workspace = mergePath
-        zonalStats = arcpy.ListTables(zsName)
-        minZS = "ZS" + str(minCP)
-        zonalStats.remove(minZS) # remove ZS1 from list and use it as the target table
-        print(zonalStats)
-        arcpy.Append_management(zonalStats, minZS, "NO_TEST") # append all tables to ZS1
-
-        # join ZS1 to cost path shapefile
-        zsTableCP = "ZonalStats_CostPath_" + assessID
-        arcpy.Rename_management(minZS, zsTableCP)
-        arcpy.JoinField_management(inCostPath, "DestID", zsTableCP, "DestID")
-        #arcpy.JoinField_management(inCostPath, "DestID", zsTableCP, "DestID", ["SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD"])
-
-        # Save to csv
-        nparrCP = arcpy.da.FeatureClassToNumPyArray(inCostPath, ["FID", "PathCost", "DestID", "SLength", "MFPGID", "SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD"])
-        pd.DataFrame(nparrCP).to_csv(resultsPath + '/CostPath_ZonalStats.csv', index=None)
-
-        for zonalStat in zonalStats: # delete all tables except ZS1
-            arcpy.management.Delete(zonalStat)
-            arcpy.management.Delete(zonalStat)
-
-        # Major Flow Path Groups
-        arcpy.JoinField_management(inMajorFlowPathGroups, "MFPGID", inCostPath, "MFPGID", "DestID")
-        mfpgValues = [row[0] for row in arcpy.da.SearchCursor(inMajorFlowPathGroups, "DestID")]
-        sliceobject = slice(1)
-        mfpgValues[sliceobject]
-        minMFPG = min(mfpgValues)
-        print minMFPG
-
-        # calculate mean and std dev Slope and Elevation values for each major flow path group
-        # for num in range(1,countMFPG + 1):
-        for mfpg in mfpgValues[:5]:
-            inMFPGfl = arcpy.management.MakeFeatureLayer(inMajorFlowPathGroups, "inMFPGfl")
-            selectOutput_MFPG = mergePath + "/MFPG_" + str(mfpg)
-            arcpy.management.SelectLayerByAttribute(inMFPGfl, "NEW_SELECTION", "\"MFPGID\" = {}".format(mfpg))
-            arcpy.CopyFeatures_management(inMFPGfl, selectOutput_MFPG)
-            outTableSlope = mergePath + "/SlopeZS" + str(mfpg)
-            inSlope = gdbPath + "/Slope" + str(GRID)
-            print(inSlope)
-            arcpy.gp.ZonalStatisticsAsTable(selectOutput_MFPG, "MFPGID", inSlope, outTableSlope, "DATA", "MEAN_STD")
-            arcpy.AlterField_management(outTableSlope, "MEAN", "SLOPE_M")
-            arcpy.AlterField_management(outTableSlope, "STD", "SLOPE_SD")
-            outTableDEM = mergePath + "/ElevationZS" + str(mfpg)
-            arcpy.gp.ZonalStatisticsAsTable(selectOutput_MFPG, "MFPGID", inDEM, outTableDEM, "DATA", "MEAN_STD")
-            arcpy.AlterField_management(outTableDEM, "MEAN", "DEM_M")
-            arcpy.AlterField_management(outTableDEM, "STD", "DEM_SD")
-            arcpy.SelectLayerByAttribute_management(inMFPGfl, "CLEAR_SELECTION", "\"MFPGID\" = \"\"")
-            arcpy.JoinField_management(outTableSlope, "MFPGID", outTableDEM, "MFPGID", ["DEM_M", "DEM_SD"])
-            outTableZS = mergePath + "/ZS" + str(mfpg)
-            arcpy.Rename_management(outTableSlope, outTableZS)
-            arcpy.management.Delete(outTableDEM)
-            arcpy.management.Delete(outTableDEM) # for stubborn files
-            arcpy.management.Delete(selectOutput_MFPG)
-            arcpy.management.Delete(selectOutput_MFPG)
-
-        # Local Variables
-        zsName =  "ZS*"
-        env.workspace = mergePath
-        zonalStats = arcpy.ListTables(zsName)
-        zonalStats.remove(minMFPG) # remove ZS1 from list and use it as the target table
-        print(zonalStats)
-        arcpy.Append_management(zonalStats, minMFPG, "NO_TEST") # append all tables to ZS1
-
-        # join ZS1 to cost path shapefile
-        zsTableMFPG = "ZonalStats_MFPG_" + assessID
-        arcpy.Rename_management(minMFPG, zsTableMFPG)
-        arcpy.JoinField_management(inMajorFlowPathGroups, "MFPGID", zsTableMFPG)
-        #arcpy.JoinField_management(inMajorFlowPathGroups, "MFPGID", zsTableMFPG, "MFPGID", ["SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD"])
-
-        # join average shape length value to major flow path groups attribute table
-        cpArray = arcpy.da.FeatureClassToNumPyArray(inCostPath, ["FID", "PathCost", "DestID", "SLength", "MFPGID", "SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD"])
-        cpDataFrame = pd.DataFrame(cpArray) # create pandas data frame
-        shapeLengthMean = cpDataFrame.groupby('MFPGID').mean() # group data frame by MFPGID
-        shapeLengthFilter = shapeLengthMean.filter(items=['MFPGID', 'SLength']) # filter data frame to only include MGFPID and mean shape length
-        outTable = resultsPath + "/outTable.csv"
-        shapeLengthFilter.to_csv(outTable) # export dataframe to csv
-        arcpy.TableToTable_conversion(outTable, mergePath, "avgSlength")
-        os.remove(outTable)
-        arcpy.JoinField_management(inMajorFlowPathGroups, "MFPGID", mergePath + "/avgSlength", "MFPGID", ["SLength"])
-
-        # export table to csv
-        nparrMFPG = arcpy.da.FeatureClassToNumPyArray(inMajorFlowPathGroups, ["FID", "MFPGID", "SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD", "SLength"])
-        pd.DataFrame(nparrMFPG).to_csv(resultsPath + '/MajorFlowPathGroup_ZonalStats.csv', index=None)
-
-        for zonalStat in zonalStats: # delete all tables except ZS1
-            arcpy.management.Delete(zonalStat)
-            arcpy.management.Delete(zonalStat)
-
-    assessName = "T*" # delete assessment unit shapefiles
-    assessUnits = arcpy.ListFeatureClasses(assessName)
-    for assessUnit in assessUnits:
-        arcpy.management.Delete(assessUnit)
-        arcpy.management.Delete(assessUnit)
-
-    arcpy.management.Delete(selectOutput_BF)
-    arcpy.management.Delete(selectOutput_BF)
-
-    arcpy.management.Delete(selectOutput_SL)
-    arcpy.management.Delete(selectOutput_SL)
-
-    arcpy.management.Delete(outSourcePoint)
-    arcpy.management.Delete(outSourcePoint)
-
-    arcpy.management.Delete(clipRaster)
-    arcpy.management.Delete(clipRaster)
-
-    arcpy.management.Delete(outSlope)
-    arcpy.management.Delete(outSlope)
-
-    arcpy.management.Delete(outReclass)
-    arcpy.management.Delete(outReclass)
-
-print("Gathering inputs: {}".format(time.ctime()))
+from rasterize import GridSpec, rowcol_to_xy
+from flowtree import chain_vertices
+from demwindow import DemSource
+from partition import add_row, basin_key, basin_partition, dataset_signature, finish_index, load_index, new_index, oid_where_clause, save_index
+from instrument import summarize
+from resultwriter import export_csv
+import flowengine
+
+NODATA = -9999 # NoData value of basin rasters written as outputs
+OUTPUT_COORDINATE_SYSTEM = "North America Albers Equal Area Conic"
+EXPORT_CSV = True # also merge the binary unit tables into one CSV per table at the end
+DEM_SOURCES = {} # per process, so basins run by the same worker share DEM tiles
+DEM_CACHE_BYTES = 512 * 1024 * 1024 # DEM tile cache of each process, out of its memory budget
+
+def array_to_raster(array, grid, outRaster=None, nodata=NODATA):
+    # an array on the basin grid as a Raster (NaN as NoData), saved if outRaster is given
+    if array.dtype.kind == "f":
+        array = numpy.where(numpy.isnan(array), nodata, array)
+    lowerLeft = arcpy.Point(grid.xmin, grid.ymax - grid.nrows * grid.cellSize)
+    raster = arcpy.NumPyArrayToRaster(array, lowerLeft, grid.cellSize, grid.cellSize, nodata)
+    if outRaster:
+        raster.save(outRaster)
+    return raster
+
+def dem_source(inRaster):
+    # tiled, cached reader over the continental DEM (one per process)
+    if inRaster not in DEM_SOURCES:
+        # basin extents come from the partition index in the output coordinate system, so
+        # the DEM grid has to be in it as well or every window is read from the wrong place
+        demSR = arcpy.Describe(inRaster).spatialReference
+        outputSR = arcpy.SpatialReference(OUTPUT_COORDINATE_SYSTEM)
+        sameSR = (demSR.factoryCode == outputSR.factoryCode if demSR.factoryCode and outputSR.factoryCode
+                  else demSR.exportToString() == outputSR.exportToString())
+        if not sameSR:
+            raise ValueError("{} is in {}, not {}: project it to the output coordinate system first".format(
+                inRaster, demSR.name, outputSR.name))
+        raster = arcpy.Raster(inRaster)
+        grid = GridSpec(raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth, raster.height, raster.width)
+        def read_block(row, col, nrows, ncols):
+            lowerLeft = arcpy.Point(grid.xmin + col * grid.cellSize, grid.ymax - (row + nrows) * grid.cellSize)
+            return arcpy.RasterToNumPyArray(raster, lowerLeft, ncols, nrows, NODATA)
+        DEM_SOURCES[inRaster] = DemSource(grid, read_block, NODATA, cacheBytes=DEM_CACHE_BYTES)
+    return DEM_SOURCES[inRaster]
+
+def shape_rings(shape):
+    # rings (exterior and holes) of a polygon
+    rings = []
+    for part in shape:
+        ring = []
+        for point in part:
+            if point is None: # a null point separates interior rings
+                rings.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        rings.append(ring)
+    return rings
+
+def chain_array(cells, grid):
+    # arcpy point array through the centres of a chain of cells (start, turns, end)
+    rows, cols = zip(*chain_vertices(cells, grid.ncols))
+    xs, ys = rowcol_to_xy(rows, cols, grid)
+    return arcpy.Array([arcpy.Point(x, y) for x, y in zip(xs, ys)])
+
+def write_cost_paths(outCostPath, batches, grid):
+    # export path stores (the unit's paths in order, in one or more batches) as one
+    # polyline per path with all of their columns as fields (LONG for integer columns,
+    # DOUBLE otherwise), like CostPathAsPolyline EACH_CELL
+    folder, name = os.path.split(outCostPath)
+    arcpy.CreateFeatureclass_management(folder, name, "POLYLINE", "", "", "", arcpy.env.outputCoordinateSystem)
+    batches = iter(batches)
+    paths = next(batches)
+    fields = list(paths.columns)
+    for field in fields:
+        arcpy.AddField_management(outCostPath, field, "LONG" if paths[field].dtype.kind in "iu" else "DOUBLE")
+    with arcpy.da.InsertCursor(outCostPath, ["SHAPE@"] + fields) as cursor:
+        while paths is not None:
+            rows = zip(*[paths[field].tolist() for field in fields])
+            for i, row in enumerate(rows):
+                cursor.insertRow([arcpy.Polyline(chain_array(paths.path(i).tolist(), grid))] + list(row))
+            paths = next(batches, None)
+
+def write_flow_path_groups(outGroups, groups, grid, groupTable):
+    # one dissolved multipart polyline per major flow path group ((MFPGID, cell chains)
+    # in MFPGID order), with the fields of its row in groupTable (structured array keyed
+    # on MFPGID; groups without a row get nulls)
+    folder, name = os.path.split(outGroups)
+    arcpy.CreateFeatureclass_management(folder, name, "POLYLINE", "", "", "", arcpy.env.outputCoordinateSystem)
+    arcpy.AddField_management(outGroups, "MFPGID", "LONG")
+    fields = [field for field in groupTable.dtype.names if field != "MFPGID"]
+    for field in fields:
+        arcpy.AddField_management(outGroups, field, "DOUBLE")
+    rows = dict((row[0], list(row[1:])) for row in groupTable[["MFPGID"] + fields].tolist())
+    with arcpy.da.InsertCursor(outGroups, ["SHAPE@", "MFPGID"] + fields) as cursor:
+        for group, chains in groups:
+            line = arcpy.Polyline(arcpy.Array([chain_array(chain, grid) for chain in chains]))
+            cursor.insertRow([line, group] + rows.get(group, [None] * len(fields)))
+
+class ArcpyBackend(object):
+    # The national inputs on ArcGIS: a basin's features are read by object id (from the
+    # partition index) straight into memory in the output coordinate system, so no
+    # Select/Split feature classes or scratch gdb are created, and only the final outputs
+    # are written (shapefiles and .tif rasters)
+
+    def __init__(self, inBF, inAU, inSL, inRaster, partition):
+        self.inputs = {"BF": inBF, "AU": inAU, "SL": inSL}
+        self.inRaster = inRaster
+        self.partition = partition
+        self.set_environment()
+
+    def __setstate__(self, state):
+        # a unit worker process gets the backend pickled, without the arcpy env settings
+        self.__dict__.update(state)
+        self.set_environment()
+
+    def set_environment(self):
+        # Environment Settings
+        env.overwriteOutput=True
+        arcpy.env.outputCoordinateSystem = arcpy.SpatialReference(OUTPUT_COORDINATE_SYSTEM)
+        arcpy.env.geographicTransformations = "WGS_1984_To_NAD_1983"
+
+    def input_hash(self):
+        return [self.partition["hash"], dataset_signature(self.inRaster)]
+
+    def cursor(self, inputName, fields):
+        # this basin's features of one input, by object id
+        where = oid_where_clause(self.partition["oidFields"][inputName], self.partition[inputName])
+        return arcpy.da.SearchCursor(self.inputs[inputName], fields, where, arcpy.env.outputCoordinateSystem)
+
+    def features(self):
+        with self.cursor("BF", ["SHAPE@"]) as cursor:
+            basin = [shape_rings(shape) for shape, in cursor]
+        # assessment units grouped by assess_id, as Split on AU_char did
+        units = {}
+        with self.cursor("AU", ["assess_id", "SHAPE@"]) as cursor:
+            for assessID, shape in cursor:
+                units.setdefault(basin_key(assessID), []).append(shape_rings(shape))
+        with self.cursor("SL", ["OID@", "SHAPE@"]) as cursor:
+            streams = [(oid, [(point.X, point.Y) for point in part if point]) for oid, shape in cursor for part in shape]
+        return {"basin": basin, "units": sorted(units.items()), "streams": streams,
+                "extent": self.partition["extent"], # pre-computed in the partition index
+                "hash": [self.partition["hash"].get("BF"), self.partition["hash"].get("SL")]}
+
+    def dem_source(self):
+        return dem_source(self.inRaster)
+
+    def write_raster(self, outName, array, grid, nodata=NODATA):
+        array_to_raster(array, grid, outName + ".tif", nodata)
+        return outName + ".tif"
+
+    def delete_output(self, outPath):
+        # a shapefile or raster with all of its side files
+        if arcpy.Exists(outPath):
+            arcpy.Delete_management(outPath)
+
+    def write_cost_paths(self, outName, batches, grid):
+        write_cost_paths(outName + ".shp", batches, grid)
+        return outName + ".shp"
+
+    def write_flow_path_groups(self, outName, groups, grid, groupTable):
+        write_flow_path_groups(outName + ".shp", groups, grid, groupTable)
+        return outName + ".shp"
+
+def flow_paths(GRID, inBF, inAU, inSL, inRaster, resultsPath, partition, unitProcesses=None, memoryBudget=None):
+    # one basin through the flow path engine with its national inputs on ArcGIS
+    flowengine.flow_paths(GRID, ArcpyBackend(inBF, inAU, inSL, inRaster, partition), resultsPath,
+                          processes=unitProcesses, memoryBudget=memoryBudget)
+
+def partition_inputs(inBF, inAU, inSL, resultsPath):
+    # Read each national input once and index its features by basin (object ids, content
+    # hashes, plus the basin extents in the output coordinate system). The index is reused
+    # until an input changes.
+    inputs = [("BF", inBF, "gridcode"), ("AU", inAU, "basin_id"), ("SL", inSL, "basin_id")]
+    indexPath = resultsPath + "/partition_index.json"
+    signatures = dict((name, dataset_signature(path)) for name, path, keyField in inputs)
+    index = load_index(indexPath, signatures)
+    if index is not None:
+        return index
+
+    outputSR = arcpy.SpatialReference(OUTPUT_COORDINATE_SYSTEM)
+    index = new_index(signatures, dict((name, arcpy.Describe(path).OIDFieldName) for name, path, keyField in inputs))
+    hashers = {}
+    for name, path, keyField in inputs:
+        # every attribute is hashed with the geometry, so an edited feature changes its basin's hash
+        fields = [keyField, "OID@", "SHAPE@"] + [field.name for field in arcpy.ListFields(path)
+                                                 if field.type not in ("OID", "Geometry")]
+        with arcpy.da.SearchCursor(path, fields, spatial_reference=outputSR) as cursor:
+            for row in cursor:
+                key, oid, shape = row[:3]
+                content = bytes(shape.WKB) + repr(row[3:]).encode("utf-8")
+                extent = None
+                if name == "BF":
+                    extent = (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                add_row(index, name, key, oid, extent, content, hashers)
+    finish_index(index, hashers)
+    save_index(index, indexPath)
+    return index
+
+def run_basin(task):
+    # worker: one basin in its own process (arcpy env settings are per process)
+    GRID, inBF, inAU, inSL, inRaster, resultsPath, partition, unitProcesses, memoryBudget = task
+    start = time.time()
+    try:
+        flow_paths(GRID, inBF, inAU, inSL, inRaster, resultsPath, partition, unitProcesses, memoryBudget)
+    except arcpy.ExecuteError:
+        return GRID, False, arcpy.GetMessages(2)
+    except Exception:
+        # any other failure (NumPy engine, memory) is this basin's alone; the run goes on
+        return GRID, False, traceback.format_exc()
+    return GRID, True, "{:.0f} s".format(time.time() - start)
+
+def merge_basins(GRIDS, resultsPath):
+    # Stream the unit tables into one CSV per table in GRIDS order (units sorted within a
+    # basin) so the merged output is deterministic. The binary tables are kept: they hold
+    # the completed units a rerun skips, and one basin reads back with read_table.
+    for tableName in ["CostPath_ZonalStats", "MajorFlowPathGroup_ZonalStats"]:
+        export_csv(resultsPath + "/tables", tableName, resultsPath + "/" + tableName + ".csv", GRIDS)
+
+def run_basins(GRIDS, inBF, inAU, inSL, inRaster, resultsPath, processes=None, unitProcesses=None):
+    # Run basins across a process pool, largest extent first so the long basins start
+    # early and the small ones fill in around them, then merge the basin outputs. Each
+    # basin spreads its assessment units over unitProcesses workers of its own, by
+    # default the share of the processes (all cores by default) the basins leave over.
+    # The basin workers are not daemonic (concurrent.futures, Python 3.9 and later), so
+    # they can start unit workers. flowengine.MEMORY_BUDGET is shared by the basins
+    # running at once, less the DEM tile cache each basin process keeps; no more basins
+    # run at once than leaves each at least as much working memory as its cache.
+    if flowengine.MEMORY_BUDGET < 2 * DEM_CACHE_BYTES:
+        raise ValueError("flowengine.MEMORY_BUDGET ({} bytes) leaves no working memory next to the DEM tile cache: "
+                         "set it to at least {} bytes (twice DEM_CACHE_BYTES) or lower DEM_CACHE_BYTES".format(
+                             flowengine.MEMORY_BUDGET, 2 * DEM_CACHE_BYTES))
+    processes = processes or multiprocessing.cpu_count()
+    index = partition_inputs(inBF, inAU, inSL, resultsPath)
+    partitions = dict((GRID, basin_partition(index, GRID)) for GRID in GRIDS)
+    missing = [GRID for GRID in GRIDS if partitions[GRID]["extent"] is None]
+    if missing:
+        print("Basins not found in {}: {}".format(inBF, missing))
+    GRIDS = [GRID for GRID in GRIDS if GRID not in missing]
+    basinWorkers = max(1, min(len(GRIDS), processes // (unitProcesses or 1),
+                              flowengine.MEMORY_BUDGET // (2 * DEM_CACHE_BYTES)))
+    unitProcesses = unitProcesses or max(1, processes // basinWorkers)
+    memoryBudget = flowengine.MEMORY_BUDGET // basinWorkers - DEM_CACHE_BYTES
+    def extent_area(GRID):
+        Xmin, Ymin, Xmax, Ymax = partitions[GRID]["extent"]
+        return (Xmax - Xmin) * (Ymax - Ymin)
+    order = sorted(GRIDS, key=extent_area, reverse=True)
+    tasks = [(GRID, inBF, inAU, inSL, inRaster, resultsPath, partitions[GRID], unitProcesses, memoryBudget)
+             for GRID in order]
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(basinWorkers) as executor:
+        futures = [executor.submit(run_basin, task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            GRID, ok, message = future.result()
+            print("Basin {} {}: {}".format(GRID, "completed" if ok else "FAILED", message))
+            if not ok:
+                failed.append(GRID)
+    if EXPORT_CSV:
+        merge_basins([GRID for GRID in GRIDS if GRID not in failed], resultsPath)
+    if flowengine.PROFILE:
+        report = summarize(glob.glob(resultsPath + "/profile/*.jsonl"), resultsPath + "/profile_summary.json")
+        for basin in report["slowestBasins"]:
+            print("Slow basin {GRID}: {wall:.0f} s, peak RSS {peak_rss} bytes".format(**basin))
+    return failed + missing
 
 GRIDS = ["1399", "1018"]
 inBF = "D:/Sara/Chapter1_Export_210521/BF_Combined_0521.shp"
 inAU = "D:/Sara/Chapter1_Export_210521/AU_Combined_0521.shp"
 inSL = "D:/Sara/Chapter1_Export_210521/SL_Combined_0521.shp"
 inRaster = "D:/Sara/DEM/CAN_DEM.tif"
+PROCESSES = None # worker processes in all (None: one per core)
+UNIT_PROCESSES = None # unit workers per basin (None: the processes the basins leave over)
 
 """
 while True:
@@ -431,44 +344,19 @@ while True:
         break
 """
 
-inPath = os.path.dirname(os.path.realpath(inBF))
-newPath = inPath.replace(os.sep, '/')
-resultsPath = newPath + "/results" # "/results"
-
-if os.path.exists(resultsPath): # create results folder
-    resultsPath = newPath + "/results"
-else:
-    #shutil.rmtree(resultsPath)
-    os.mkdir(resultsPath)
+if __name__ == "__main__":
+    print("Gathering inputs: {}".format(time.ctime()))
 
-gdbPath = resultsPath + "/flowpaths.gdb" # create flow path gdb
-gdbName = "flowpaths.gdb"
-
-if arcpy.Exists(gdbPath):
-    gdbPath = resultsPath + "/flowpaths.gdb"
-else:
-    #shutil.rmtree(gdbPath)
-    arcpy.CreateFileGDB_management(resultsPath, gdbName)
-
-mergePath = resultsPath + "/flowpathsMerge.gdb" # create flow path gdb
-mergeName = "flowpathsMerge.gdb"
-
-if arcpy.Exists(mergePath):
-    mergePath = resultsPath + "/flowpathsMerge.gdb"
-else:
-    #shutil.rmtree(mergePath)
-    arcpy.CreateFileGDB_management(resultsPath, mergeName)
-
-print("Generating Flow Paths and Major Flow Paths: {}".format(time.ctime()))
+    inPath = os.path.dirname(os.path.realpath(inBF))
+    newPath = inPath.replace(os.sep, '/')
+    resultsPath = newPath + "/results" # "/results"
 
-for GRID in GRIDS:
-    flow_paths(inBF, inAU, inSL, inRaster)
+    if not os.path.exists(resultsPath): # create results folder
+        os.mkdir(resultsPath)
 
+    print("Generating Flow Paths and Major Flow Paths: {}".format(time.ctime()))
 
-#for GRID in GRIDS:
-#    try:
-#        flow_paths(inBF, inAU, inSL, inRaster)
-#    except arcpy.ExecuteError:
-#        print(arcpy.GetMessages())
-#    finally:
-#        print("Code completed")
+    failed = run_basins(GRIDS, inBF, inAU, inSL, inRaster, resultsPath, PROCESSES, UNIT_PROCESSES)
+    print("Code completed: {}".format(time.ctime()))
+    if failed:
+        print("Failed basins: {}".format(failed))
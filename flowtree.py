@@ -0,0 +1,67 @@
+# flowtree.py
+# PURPOSE : To trace the least cost path of every cell at once by following the
+#           backlink raster as a forest (one parent index per cell) instead of
+#           walking one polyline per cell as CostPathAsPolyline EACH_CELL does
+# Inputs  : backlink array from pathdistance.path_distance
+# OUTPUTS : parent index per cell; per-path length, cost and endpoint on demand
+
+import numpy
+from pathdistance import MOVES
+
+ROOT = -1   # parent of a source cell (backlink 0)
+NOPATH = -2 # parent of a cell without a path (backlink NoData)
+
+
+def backlink_parents(backlink):
+    # flat parent cell index for every cell of a backlink array
+    nrows, ncols = backlink.shape
+    codes = numpy.asarray(backlink).ravel().astype(numpy.int64)
+    offsets = numpy.array([0] + [dr * ncols + dc for dr, dc in MOVES], dtype=numpy.int64)
+    parent = numpy.full(codes.shape, NOPATH, dtype=numpy.int64)
+    linked = (codes >= 1) & (codes <= len(MOVES))
+    cells = numpy.flatnonzero(linked)
+    parent[cells] = cells + offsets[codes[cells]]
+    parent[codes == 0] = ROOT
+    return parent
+
+
+def path_sum(parent, values):
+    # Sum of values along every path, from the cell itself down to its source, by
+    # pointer jumping: each round doubles the stretch of path already summed, so the
+    # whole forest takes log2(longest path) vectorized passes. Cells without a path get 0.
+    n = len(parent)
+    sentinel = n
+    jump = numpy.where(parent >= 0, parent, sentinel)
+    jump = numpy.append(jump, sentinel)
+    total = numpy.append(numpy.where(parent != NOPATH, numpy.asarray(values, dtype=numpy.float64).ravel(), 0.0), 0.0)
+    while (jump[:n] != sentinel).any():
+        total = total + total[jump]
+        jump = jump[jump]
+    return total[:n]
+
+
+def path_length(parent):
+    # number of cells on every path, source cell included (0 without a path)
+    return path_sum(parent, numpy.ones(len(parent))).astype(numpy.int64)
+
+
+def path_root(parent):
+    # source cell every path ends at (NOPATH without a path)
+    root = numpy.where(parent >= 0, parent, numpy.arange(len(parent)))
+    while True:
+        nextRoot = root[root]
+        if numpy.array_equal(nextRoot, root):
+            break
+        root = nextRoot
+    return numpy.where(parent == NOPATH, NOPATH, root)
+
+
+def chain_vertices(cells, ncols):
+    # (row, col) of a chain of cells' first cell, turns and last cell
+    vertices = [divmod(cells[0], ncols)]
+    for i in range(1, len(cells) - 1):
+        if cells[i] - cells[i - 1] != cells[i + 1] - cells[i]:
+            vertices.append(divmod(cells[i], ncols))
+    if len(cells) > 1:
+        vertices.append(divmod(cells[-1], ncols))
+    return vertices
@@ -0,0 +1,154 @@
+# instrument.py
+# PURPOSE : To time every stage of a basin run and record its CPU, memory and I/O
+#           as JSON lines, and to summarize those records across basins
+# Inputs  : stage names and context (GRID, assess_id) from flowpaths.flow_paths
+# OUTPUTS : profile/<GRID>.jsonl per basin, profile_summary.json for the run
+
+import json
+import os
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def reset_peak_rss():
+    # Start a new resident memory peak (Linux: VmHWM through clear_refs). Pool workers
+    # run many basins, so the peak since the process started says little about a stage.
+    # Returns False where the peak cannot be reset.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def rss_bytes():
+    # (current, peak since reset_peak_rss) resident memory of this process
+    if os.path.exists("/proc/self/status"):
+        values = {}
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value = line.split(":")
+                    values[name] = int(value.split()[0]) * 1024 # kB
+        return values.get("VmRSS"), values.get("VmHWM")
+    if psutil is not None:
+        rss = psutil.Process().memory_info().rss
+        return rss, None
+    return None, None
+
+
+def io_bytes():
+    # (read, written) bytes of this process, network storage included
+    if os.path.exists("/proc/self/io"):
+        counters = {}
+        with open("/proc/self/io") as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name] = int(value)
+        return counters.get("rchar", 0), counters.get("wchar", 0)
+    if psutil is not None:
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    return 0, 0
+
+
+class Profiler(object):
+    # Stages of a run are sequential, so each done() records everything since the
+    # previous done() (or mark()): wall and CPU time, I/O bytes, resident memory (at the
+    # end and the peak of the stage) and any counts passed in (cells, features, datasets
+    # created or deleted).
+
+    def __init__(self, outPath, **context):
+        folder = os.path.dirname(outPath)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.outPath = outPath
+        self.context = context
+        open(outPath, "w").close() # a rerun replaces the basin's previous records
+        self.mark()
+
+    def mark(self):
+        self.wall = time.time()
+        self.cpu = cpu_seconds()
+        self.io = io_bytes()
+        self.peakReset = reset_peak_rss()
+
+    def done(self, stage, **counts):
+        wall, cpu = time.time(), cpu_seconds()
+        read, written = io_bytes()
+        rss, peak = rss_bytes()
+        # the stage peak where it can be reset, otherwise the resident memory at its end
+        record = dict(self.context, stage=stage, wall=wall - self.wall, cpu=cpu - self.cpu, rss=rss,
+                      peak_rss=peak if self.peakReset and peak is not None else rss,
+                      read_bytes=read - self.io[0], write_bytes=written - self.io[1])
+        record.update((name, int(value)) for name, value in counts.items())
+        with open(self.outPath, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+        self.wall, self.cpu, self.io = wall, cpu, (read, written)
+        self.peakReset = reset_peak_rss()
+
+
+class NullProfiler(object):
+    # profiling switched off: nothing is measured or written
+
+    def __init__(self):
+        self.context = {}
+
+    def mark(self):
+        pass
+
+    def done(self, stage, **counts):
+        pass
+
+
+def open_profiler(outPath, enabled=True, **context):
+    return Profiler(outPath, **context) if enabled else NullProfiler()
+
+
+def read_records(profilePaths):
+    records = []
+    for path in profilePaths:
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+def summarize(profilePaths, outPath=None, outliers=10):
+    # Totals per stage across basins, and the basins with the most wall time
+    records = read_records(profilePaths)
+    measures = ["GRID", "assess_id", "stage", "wall", "cpu", "rss", "peak_rss", "read_bytes", "write_bytes"]
+    stages = {}
+    basins = {}
+    for record in records:
+        summary = stages.setdefault(record["stage"], {"calls": 0, "wall": 0.0, "cpu": 0.0, "maxWall": 0.0,
+                                                      "read_bytes": 0, "write_bytes": 0, "peak_rss": 0})
+        summary["calls"] += 1
+        summary["wall"] += record["wall"]
+        summary["cpu"] += record["cpu"]
+        summary["maxWall"] = max(summary["maxWall"], record["wall"])
+        summary["read_bytes"] += record["read_bytes"]
+        summary["write_bytes"] += record["write_bytes"]
+        summary["peak_rss"] = max(summary["peak_rss"], record.get("peak_rss") or 0)
+        for name, value in record.items():
+            if name not in measures and isinstance(value, int):
+                summary[name] = summary.get(name, 0) + value # cells, features, datasets
+        basin = basins.setdefault(str(record.get("GRID")), {"wall": 0.0, "peak_rss": 0})
+        basin["wall"] += record["wall"]
+        basin["peak_rss"] = max(basin["peak_rss"], record.get("peak_rss") or 0)
+    slowest = sorted(basins.items(), key=lambda item: item[1]["wall"], reverse=True)[:outliers]
+    report = {"stages": stages, "basins": len(basins),
+              "slowestBasins": [dict(GRID=GRID, **basin) for GRID, basin in slowest]}
+    if outPath:
+        with open(outPath, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return report
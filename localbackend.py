@@ -0,0 +1,115 @@
+# localbackend.py
+# PURPOSE : To run flowengine.flow_paths without arcpy: basin inputs come from a folder
+#           written by synthetic.save_basin (or exported in the same layout) and outputs
+#           are written as GeoJSON lines and .npy rasters
+# Inputs  : <folder>/dem.npy, <folder>/basin.json
+# OUTPUTS : CostPath_<assess_id>.geojson, MajorFlowPathGroups_assess_<assess_id>.geojson,
+#           tables, manifest and profile under the results folder
+
+import json
+import os
+import sys
+import numpy
+from rasterize import rowcol_to_xy
+from flowtree import chain_vertices
+from demwindow import npy_dem
+from manifest import content_hash
+from partition import basin_key, dataset_signature
+from synthetic import load_basin
+
+
+def chain_coordinates(cells, grid):
+    # [x, y] through the centres of a chain of cells (start, turns, end)
+    rows, cols = zip(*chain_vertices(cells, grid.ncols))
+    xs, ys = rowcol_to_xy(rows, cols, grid)
+    return [[x, y] for x, y in zip(xs.tolist(), ys.tolist())]
+
+
+def write_geojson(outPath, features):
+    # features (any iterable) are written one at a time, never held together in memory
+    with open(outPath, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for i, feature in enumerate(features):
+            f.write(",\n" if i else "\n")
+            json.dump(feature, f)
+        f.write("\n]}\n")
+    return outPath
+
+
+def line_feature(coordinates, properties):
+    # NoData (NaN) attributes become null
+    geometry = {"type": "MultiLineString", "coordinates": coordinates}
+    properties = dict((name, None if value != value else value) for name, value in properties.items())
+    return {"type": "Feature", "geometry": geometry, "properties": properties}
+
+
+class LocalBackend(object):
+    # Basin folder on local disk; every intermediate stays in memory
+
+    def __init__(self, basinFolder):
+        self.basinFolder = basinFolder
+        self.basin = load_basin(basinFolder)
+        self.dem = npy_dem(basinFolder + "/dem.npy", self.basin["grid"])
+
+    def __getstate__(self):
+        # unit workers reopen the basin folder rather than receive the arrays
+        return {"basinFolder": self.basinFolder}
+
+    def __setstate__(self, state):
+        self.__init__(state["basinFolder"])
+
+    def input_hash(self):
+        return [dataset_signature(self.basinFolder + "/basin.json"), dataset_signature(self.basinFolder + "/dem.npy")]
+
+    def features(self):
+        basin = self.basin
+        xs = [x for ring in basin["basin"] for x, y in ring]
+        ys = [y for ring in basin["basin"] for x, y in ring]
+        return {"basin": [basin["basin"]],
+                "units": [(basin_key(assessID), [rings]) for assessID, rings in basin["units"]],
+                "streams": [(label, vertices) for label, vertices in basin["streams"]],
+                "extent": (min(xs), min(ys), max(xs), max(ys)),
+                "hash": content_hash(basin["basin"], basin["streams"])}
+
+    def dem_source(self):
+        return self.dem
+
+    def write_raster(self, outName, array, grid, nodata=None):
+        # the array (NaN as NoData) with its grid next to it
+        numpy.save(outName + ".npy", array)
+        with open(outName + ".json", "w") as f:
+            json.dump({"grid": list(grid), "nodata": nodata}, f)
+        return outName + ".npy"
+
+    def delete_output(self, outPath):
+        # an output written by this backend, with the grid file of a raster
+        paths = [outPath] + ([outPath[:-len(".npy")] + ".json"] if outPath.endswith(".npy") else [])
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def write_cost_paths(self, outName, batches, grid):
+        # batches: path stores of the unit's paths in order, one (in memory) or many (tiled)
+        def features():
+            for paths in batches:
+                fields = list(paths.columns)
+                rows = zip(*[paths[field].tolist() for field in fields])
+                for i, row in enumerate(rows):
+                    yield line_feature([chain_coordinates(paths.path(i).tolist(), grid)], dict(zip(fields, row)))
+        return write_geojson(outName + ".geojson", features())
+
+    def write_flow_path_groups(self, outName, groups, grid, groupTable):
+        # groups: (MFPGID, cell chains) in MFPGID order, e.g. from flowgroups.group_parts
+        fields = [field for field in groupTable.dtype.names if field != "MFPGID"]
+        rows = dict((row[0], row[1:]) for row in groupTable[["MFPGID"] + fields].tolist())
+        features = (line_feature([chain_coordinates(chain, grid) for chain in chains],
+                                 dict(zip(fields, rows.get(group, [None] * len(fields))), MFPGID=group))
+                    for group, chains in groups)
+        return write_geojson(outName + ".geojson", features)
+
+
+if __name__ == "__main__":
+    # python localbackend.py <basin folder> <results folder> [GRID]
+    from flowengine import flow_paths
+    basinFolder, resultsPath = sys.argv[1], sys.argv[2]
+    flow_paths(sys.argv[3] if len(sys.argv) > 3 else "local", LocalBackend(basinFolder), resultsPath)
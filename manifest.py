@@ -0,0 +1,68 @@
+# manifest.py
+# PURPOSE : To record which basins and assessment units are complete, keyed on hashes
+#           of their inputs, so a rerun only recomputes what changed
+# Inputs  : feature/DEM/parameter hashes and the output files of each unit
+# OUTPUTS : manifest/<GRID>.json in the results folder, one per basin
+
+import hashlib
+import json
+import os
+import numpy
+
+
+def content_hash(*items):
+    # sha1 over arrays (dtype, shape and bytes), bytes, and JSON-able values
+    hasher = hashlib.sha1()
+    for item in items:
+        if isinstance(item, numpy.ndarray):
+            hasher.update(str(item.dtype).encode("utf-8"))
+            hasher.update(str(item.shape).encode("utf-8"))
+            hasher.update(numpy.ascontiguousarray(item).tobytes())
+        elif isinstance(item, bytes):
+            hasher.update(item)
+        else:
+            hasher.update(json.dumps(item, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def new_manifest(GRID, basinHash):
+    return {"GRID": GRID, "basinHash": basinHash, "demHash": None, "units": {}, "complete": False}
+
+
+def load_manifest(manifestPath):
+    if not os.path.exists(manifestPath):
+        return None
+    with open(manifestPath) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifestPath):
+    # write to a temporary file first so an interrupted run never leaves half a manifest
+    folder = os.path.dirname(manifestPath)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    tmpPath = manifestPath + ".tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmpPath, manifestPath) # atomic, the previous file stays until the new one is in place
+
+
+def outputs_exist(outputs):
+    return all(os.path.exists(output) for output in outputs)
+
+
+def unit_is_current(manifest, assessID, unitHash):
+    # a unit is up to date if it finished with the same input hash and its outputs remain
+    unit = (manifest or {}).get("units", {}).get(str(assessID))
+    return unit is not None and unit["hash"] == unitHash and outputs_exist(unit["outputs"])
+
+
+def basin_is_current(manifest, basinHash):
+    # the whole basin can be skipped without reading anything
+    if manifest is None or not manifest.get("complete") or manifest.get("basinHash") != basinHash:
+        return False
+    return all(outputs_exist(unit["outputs"]) for unit in manifest["units"].values())
+
+
+def record_unit(manifest, assessID, unitHash, outputs):
+    manifest["units"][str(assessID)] = {"hash": unitHash, "outputs": list(outputs)}
@@ -0,0 +1,108 @@
+# partition.py
+# PURPOSE : To index the national basin, assessment unit and stream link inputs by
+#           basin in one read, so each basin run only touches its own features
+# Inputs  : (basin key, object id[, extent]) rows read once from each input
+# OUTPUTS : partition_index.json with per-basin object ids, basin extents and a content
+#           hash of each basin's features per input
+
+import hashlib
+import json
+import os
+
+INDEX_VERSION = 2 # indexes written by older code are rebuilt
+
+
+def basin_key(value):
+    # gridcode/basin_id as the GRID string used throughout the run ("1399", not 1399.0)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def dataset_signature(path):
+    # size and modification time of a dataset's files; an edited input rebuilds the index
+    root, ext = os.path.splitext(path)
+    files = [root + sidecar for sidecar in [".shp", ".dbf", ".shx"]] if ext.lower() == ".shp" else [path]
+    signature = []
+    for name in files:
+        if os.path.exists(name):
+            stat = os.stat(name)
+            signature.append([os.path.basename(name), stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def new_index(signatures, oidFields):
+    return {"version": INDEX_VERSION, "signatures": signatures, "oidFields": oidFields, "basins": {}}
+
+
+def add_row(index, inputName, key, oid, extent=None, content=None, hashers=None):
+    # record one feature of an input under its basin; extents are unioned per basin and
+    # the feature content (geometry and attributes) is fed to the basin's input hash
+    basin = index["basins"].setdefault(basin_key(key), {})
+    if content is not None:
+        hashers.setdefault((basin_key(key), inputName), hashlib.sha1()).update(content)
+    basin.setdefault(inputName, []).append(int(oid))
+    if extent is not None:
+        old = basin.get("extent")
+        basin["extent"] = list(extent) if old is None else [
+            min(old[0], extent[0]), min(old[1], extent[1]), max(old[2], extent[2]), max(old[3], extent[3])]
+
+
+def finish_index(index, hashers):
+    # store the per-basin input hashes once every input has been read
+    for (key, inputName), hasher in hashers.items():
+        index["basins"][key].setdefault("hash", {})[inputName] = hasher.hexdigest()
+    return index
+
+
+def save_index(index, indexPath):
+    with open(indexPath, "w") as f:
+        json.dump(index, f)
+
+
+def load_index(indexPath, signatures):
+    # the saved index, or None if it is missing or any input changed since it was built
+    if not os.path.exists(indexPath):
+        return None
+    with open(indexPath) as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION or index.get("signatures") != signatures:
+        return None
+    return index
+
+
+def basin_partition(index, GRID):
+    # the slice of the index one basin run needs (small enough to hand to a worker)
+    basin = index["basins"].get(basin_key(GRID), {})
+    partition = {"oidFields": index["oidFields"], "extent": basin.get("extent"), "hash": basin.get("hash", {})}
+    for inputName in index["oidFields"]:
+        partition[inputName] = basin.get(inputName, [])
+    return partition
+
+
+def oid_ranges(oids):
+    # sorted object ids collapsed into (first, last) runs
+    ranges = []
+    for oid in sorted(set(oids)):
+        if ranges and oid == ranges[-1][1] + 1:
+            ranges[-1][1] = oid
+        else:
+            ranges.append([oid, oid])
+    return ranges
+
+
+def oid_where_clause(oidField, oids):
+    # Where clause selecting a basin's features by object id. Inputs are usually sorted
+    # by basin, so runs of ids become BETWEEN ranges and the clause stays short.
+    if not oids:
+        return "{} < 0".format(oidField)
+    terms = []
+    singles = []
+    for first, last in oid_ranges(oids):
+        if first == last:
+            singles.append(str(first))
+        else:
+            terms.append("({0} >= {1} AND {0} <= {2})".format(oidField, first, last))
+    if singles:
+        terms.append("{} IN ({})".format(oidField, ", ".join(singles)))
+    return " OR ".join(terms)
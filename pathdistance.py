@@ -0,0 +1,162 @@
+# pathdistance.py
+# PURPOSE : To calculate accumulated path distance and backlink rasters from NumPy
+#           arrays with the semantics of the Spatial Analyst Path Distance tool,
+#           so flow paths can be generated without ArcGIS
+# Inputs  : source mask, cost, surface and vertical rasters as arrays, vertical factor
+# OUTPUTS : accumulated cost distance (NaN = NoData) and backlink (int8, -1 = NoData)
+
+import heapq
+import math
+import numpy
+
+BACKLINK_NODATA = -1
+
+# Neighbour moves (row offset, column offset) numbered like the ArcGIS backlink
+# raster: 1 = east, then clockwise to 8 = north east. A backlink value names the
+# neighbour a cell was reached from, i.e. the next step back towards the source.
+MOVES = [(0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1)]
+
+# Vertical factor keywords and their default parameters (zero factor, low cut
+# angle, high cut angle, slope), as documented for the Path Distance tool
+VERTICAL_FACTOR_DEFAULTS = {
+    "BINARY": [1.0, -30.0, 30.0],
+    "LINEAR": [1.0, -90.0, 90.0, 1.0 / 90.0],
+    "SYMMETRIC_LINEAR": [1.0, -90.0, 90.0, 1.0 / 90.0],
+}
+
+
+def vertical_factor(spec):
+    # Returns a function mapping the vertical relative moving angle (VRMA, degrees,
+    # from the FROM cell to the TO cell) to a vertical factor; moves outside the cut
+    # angles cost infinity. spec is either a keyword string as passed to
+    # PathDistance_sa, e.g. "LINEAR 2 -90 90 -0.022222", or a table of
+    # (angle, factor) rows which is interpolated linearly like the TABLE option.
+    if not isinstance(spec, str):
+        table = numpy.asarray(spec, dtype=numpy.float64)
+        order = numpy.argsort(table[:, 0])
+        angles, factors = table[order, 0], table[order, 1]
+
+        def table_factor(vrma):
+            vf = numpy.interp(vrma, angles, factors)
+            return numpy.where((vrma < angles[0]) | (vrma > angles[-1]), numpy.inf, vf)
+        return table_factor
+
+    words = spec.split()
+    keyword = words[0].upper()
+    if keyword not in VERTICAL_FACTOR_DEFAULTS:
+        raise ValueError("Unsupported vertical factor: {}".format(spec))
+    params = list(VERTICAL_FACTOR_DEFAULTS[keyword])
+    for i, word in enumerate(words[1:len(params) + 1]):
+        params[i] = float(word)
+    zeroFactor, lowCut, highCut = params[:3]
+
+    def keyword_factor(vrma):
+        if keyword == "BINARY":
+            vf = numpy.full(numpy.shape(vrma), zeroFactor)
+        elif keyword == "LINEAR":
+            vf = zeroFactor + params[3] * vrma
+        else:
+            vf = zeroFactor + params[3] * numpy.abs(vrma)
+        return numpy.where((vrma <= lowCut) | (vrma >= highCut) | (vf < 0), numpy.inf, vf)
+    return keyword_factor
+
+
+def shifted(array, dr, dc, fill=numpy.nan):
+    # value of the neighbour at (row + dr, col + dc) for every cell
+    nrows, ncols = array.shape
+    out = numpy.full(array.shape, fill, dtype=array.dtype)
+    out[max(-dr, 0):nrows - max(dr, 0), max(-dc, 0):ncols - max(dc, 0)] = \
+        array[max(dr, 0):nrows + min(dr, 0), max(dc, 0):ncols + min(dc, 0)]
+    return out
+
+
+def passable(cost, surface, vertical=None, mask=None):
+    # cells with data in every input and inside the analysis mask
+    valid = numpy.isfinite(cost) & numpy.isfinite(surface)
+    if vertical is not None:
+        valid &= numpy.isfinite(vertical)
+    if mask is not None:
+        valid &= numpy.asarray(mask, dtype=bool)
+    return valid
+
+
+def move_costs(cost, surface, cellSize, verticalFactor, vertical=None, mask=None):
+    # Cost of moving from every cell to each of its 8 neighbours, shape (8, nrows, ncols):
+    #   surface distance * mean of the two cell costs * vertical factor
+    # with surface distance sqrt(horizontal distance ** 2 + elevation change ** 2).
+    cost = numpy.asarray(cost, dtype=numpy.float64)
+    surface = numpy.asarray(surface, dtype=numpy.float64)
+    vertical = surface if vertical is None else numpy.asarray(vertical, dtype=numpy.float64)
+    vf = vertical_factor(verticalFactor)
+    cost = numpy.where(passable(cost, surface, vertical, mask), cost, numpy.nan)
+
+    edges = numpy.empty((len(MOVES),) + cost.shape, dtype=numpy.float64)
+    with numpy.errstate(invalid="ignore"):
+        for k, (dr, dc) in enumerate(MOVES):
+            horizontal = cellSize * (math.sqrt(2.0) if dr and dc else 1.0)
+            rise = shifted(surface, dr, dc) - surface
+            vrma = numpy.degrees(numpy.arctan((shifted(vertical, dr, dc) - vertical) / horizontal))
+            edge = numpy.hypot(horizontal, rise) * 0.5 * (cost + shifted(cost, dr, dc)) * vf(vrma)
+            edges[k] = numpy.where(numpy.isfinite(edge), edge, numpy.inf)
+    return edges
+
+
+def dijkstra(edges, dist, back):
+    # Dijkstra front over flat cell indices, started from every cell with a finite
+    # distance in dist (sources at 0, or distances already known, e.g. from the halo of a
+    # tile). Move costs, distances and backlinks stay NumPy arrays, read and written
+    # through flat memoryviews. A heap entry is one int: the bits of a cell's distance
+    # (non-negative floats order like their bits) above the cell index. Stale entries
+    # (the cell's distance has dropped since) are skipped when popped instead of being
+    # decreased in place. Returns the updated (dist, back) arrays.
+    nrows, ncols = edges.shape[1:]
+    edges = numpy.ascontiguousarray(edges, dtype=numpy.float64).reshape(len(MOVES), -1)
+    offsets = [dr * ncols + dc for dr, dc in MOVES]
+    # backlink of the TO cell points back along the move, e.g. a move east gives 5 (west)
+    backCodes = [(k + 4) % 8 + 1 for k in range(len(MOVES))]
+    inf = float("inf")
+
+    dist = numpy.array(dist, dtype=numpy.float64).ravel()
+    back = numpy.array(back, dtype=numpy.int8).ravel()
+    shift = max(int(dist.size).bit_length(), 1)
+    mask = (1 << shift) - 1
+    distBits = memoryview(dist.view(numpy.uint64))
+    seeds = numpy.flatnonzero(numpy.isfinite(dist))
+    heap = ((dist[seeds].view(numpy.uint64).astype(object) << shift) | seeds.astype(object)).tolist()
+    heapq.heapify(heap)
+
+    distView, backView = memoryview(dist), memoryview(back)
+    moves = list(zip([memoryview(edgeRow) for edgeRow in edges], offsets, backCodes))
+    heappush, heappop = heapq.heappush, heapq.heappop
+    while heap:
+        key = heappop(heap)
+        cell = key & mask
+        if key >> shift != distBits[cell]:
+            continue
+        d = distView[cell]
+        for edgeView, offset, backCode in moves:
+            step = edgeView[cell]
+            if step == inf:
+                continue
+            neighbour = cell + offset
+            nd = d + step
+            if nd < distView[neighbour]:
+                distView[neighbour] = nd
+                backView[neighbour] = backCode
+                heappush(heap, (distBits[neighbour] << shift) | neighbour)
+
+    return dist.reshape(nrows, ncols), back.reshape(nrows, ncols)
+
+
+def path_distance(source, cost, surface, cellSize, verticalFactor="BINARY 1 -30 30",
+                  vertical=None, mask=None):
+    # accumulated cost distance from the source cells and the backlink towards them
+    edges = move_costs(cost, surface, cellSize, verticalFactor, vertical, mask)
+    valid = passable(numpy.asarray(cost, dtype=numpy.float64), numpy.asarray(surface, dtype=numpy.float64),
+                     None if vertical is None else numpy.asarray(vertical, dtype=numpy.float64), mask)
+    sources = numpy.asarray(source, dtype=bool) & valid
+    dist = numpy.where(sources, 0.0, numpy.inf)
+    back = numpy.where(sources, 0, BACKLINK_NODATA).astype(numpy.int8)
+    distance, backlink = dijkstra(edges, dist, back)
+    distance[numpy.isinf(distance)] = numpy.nan
+    return distance, backlink
@@ -0,0 +1,86 @@
+# pathstore.py
+# PURPOSE : To lay out the cost paths of an assessment unit as flat arrays (CSR layout)
+#           for export: per-path offsets into one int32 array of cell indices plus one
+#           column per path attribute. Path attributes themselves are computed on the
+#           flow tree (flowtree.path_sum), so paths are only traced when lines are written.
+#           A store never leaves the process that traced it: every unit worker exports
+#           its own paths, and what workers share without copying are the basin arrays
+#           they trace from (memory-mapped .npy files, flowengine.share_basin; the
+#           parent scratch array of a tiled basin).
+# Inputs  : parent index per cell from flowtree.backlink_parents, path attribute columns
+# OUTPUTS : PathStore; structured tables of path columns
+
+import collections
+import numpy
+from flowtree import path_length
+
+CELL_DTYPE = numpy.int32
+
+
+class PathStore(object):
+    # Path i covers cells[offsets[i]:offsets[i + 1]], from its start cell down to its
+    # source cell. Columns hold one value per path (DestID, PathCost, SLength, MFPGID, ...).
+
+    def __init__(self, offsets, cells, columns=None):
+        self.offsets = offsets
+        self.cells = cells
+        self.columns = collections.OrderedDict(columns or [])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        values = numpy.asarray(values)
+        if len(values) != len(self):
+            raise ValueError("column {} has {} values for {} paths".format(name, len(values), len(self)))
+        self.columns[name] = values
+
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+    def path(self, i):
+        return self.cells[self.offsets[i]:self.offsets[i + 1]]
+
+    def table(self, names, indexField=None):
+        return column_table(self.columns, names, indexField)
+
+
+def column_table(columns, names, indexField=None):
+    # structured array of some columns (plus a 0.. row index), e.g. for ExtendTable
+    dtype = [(indexField, numpy.int64)] if indexField else []
+    dtype += [(name, numpy.asarray(columns[name]).dtype) for name in names]
+    table = numpy.zeros(len(columns[names[0]]), dtype=dtype)
+    if indexField:
+        table[indexField] = numpy.arange(len(table))
+    for name in names:
+        table[name] = columns[name]
+    return table
+
+
+def trace_paths(parent, starts=None, columns=None, lengths=None):
+    # Every path of the flow tree (default: one per cell with a path, in cell order)
+    # laid out end to end, with columns (one value per path) attached. All paths advance
+    # one step per vectorized pass, so the number of passes is the longest path, not the
+    # number of paths. lengths (cells per path, if already known) saves summing them
+    # over the whole tree.
+    if starts is None:
+        starts = numpy.flatnonzero(parent >= 0)
+    if len(parent) > numpy.iinfo(CELL_DTYPE).max:
+        raise ValueError("{} cells do not fit {} cell indices".format(len(parent), CELL_DTYPE.__name__))
+    if lengths is None:
+        lengths = path_length(parent)[starts]
+    offsets = numpy.zeros(len(starts) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    cells = numpy.empty(offsets[-1], dtype=CELL_DTYPE)
+    position = offsets[:-1].copy()
+    current = numpy.asarray(starts, dtype=numpy.int64)
+    active = numpy.flatnonzero(lengths > 0)
+    while len(active):
+        cells[position[active]] = current[active]
+        position[active] += 1
+        current[active] = parent[current[active]]
+        active = active[current[active] >= 0]
+    return PathStore(offsets, cells, columns)
@@ -0,0 +1,146 @@
+# rasterize.py
+# PURPOSE : To burn vector geometry (cost path polylines, stream links) into the
+#           cell grid of a basin raster without an ArcGIS conversion tool
+# Inputs  : polyline vertices read from arcpy.da cursors
+# OUTPUTS : (label, cell) pairs indexing a row-major basin raster
+
+import collections
+import numpy
+
+# Basin raster geometry: upper left corner, square cell size and shape in cells
+GridSpec = collections.namedtuple("GridSpec", ["xmin", "ymax", "cellSize", "nrows", "ncols"])
+
+
+def xy_to_rowcol(x, y, grid):
+    # row/column of the cell containing each coordinate (may fall outside the grid)
+    col = numpy.floor((numpy.asarray(x, dtype=float) - grid.xmin) / grid.cellSize).astype(numpy.int64)
+    row = numpy.floor((grid.ymax - numpy.asarray(y, dtype=float)) / grid.cellSize).astype(numpy.int64)
+    return row, col
+
+
+def rowcol_to_xy(row, col, grid):
+    # coordinates of cell centres
+    x = grid.xmin + (numpy.asarray(col, dtype=float) + 0.5) * grid.cellSize
+    y = grid.ymax - (numpy.asarray(row, dtype=float) + 0.5) * grid.cellSize
+    return x, y
+
+
+def bounding_window(rings, grid, halo=0):
+    # Rows and columns (as slices) of the cells covering the bounding box of the rings,
+    # grown by halo cells and clipped to the grid, and the GridSpec of that window
+    xy = numpy.concatenate([numpy.asarray(ring, dtype=float).reshape(-1, 2) for ring in rings])
+    col0 = max(int(numpy.floor((xy[:, 0].min() - grid.xmin) / grid.cellSize)) - halo, 0)
+    col1 = min(int(numpy.ceil((xy[:, 0].max() - grid.xmin) / grid.cellSize)) + halo, grid.ncols)
+    row0 = max(int(numpy.floor((grid.ymax - xy[:, 1].max()) / grid.cellSize)) - halo, 0)
+    row1 = min(int(numpy.ceil((grid.ymax - xy[:, 1].min()) / grid.cellSize)) + halo, grid.nrows)
+    row1, col1 = max(row1, row0), max(col1, col0)
+    window = GridSpec(grid.xmin + col0 * grid.cellSize, grid.ymax - row0 * grid.cellSize, grid.cellSize,
+                      row1 - row0, col1 - col0)
+    return slice(row0, row1), slice(col0, col1), window
+
+
+def window_cells(cells, rows, cols, grid):
+    # flat cell indices of a window (from bounding_window) as indices of the full grid
+    r, c = numpy.divmod(numpy.asarray(cells, dtype=numpy.int64), cols.stop - cols.start)
+    return (r + rows.start) * grid.ncols + c + cols.start
+
+
+def polyline_cells(parts, grid):
+    # parts: iterable of (label, vertices) with vertices an (n, 2) sequence of x/y.
+    # Every segment is sampled once per cell along its major axis, so a path that
+    # moves between cell centres (as cost paths do) hits exactly the cells it crosses.
+    # Returns unique (label, cell) pairs; a cell shared by several paths appears once
+    # per path, which is what a per-path zonal statistic needs.
+    segLabels, segStarts, segEnds = [], [], []
+    for label, vertices in parts:
+        xy = numpy.asarray(vertices, dtype=float).reshape(-1, 2)
+        if len(xy) == 0:
+            continue
+        if len(xy) == 1:
+            xy = numpy.vstack([xy, xy])
+        segStarts.append(xy[:-1])
+        segEnds.append(xy[1:])
+        segLabels.append(numpy.full(len(xy) - 1, label, dtype=numpy.int64))
+
+    if not segLabels:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty.copy()
+
+    labels = numpy.concatenate(segLabels)
+    start = numpy.concatenate(segStarts)
+    end = numpy.concatenate(segEnds)
+
+    # continuous cell coordinates (column, row) of segment ends
+    c0 = (start[:, 0] - grid.xmin) / grid.cellSize
+    r0 = (grid.ymax - start[:, 1]) / grid.cellSize
+    dc = (end[:, 0] - grid.xmin) / grid.cellSize - c0
+    dr = (grid.ymax - end[:, 1]) / grid.cellSize - r0
+
+    # samples per segment: one per cell along the major axis, both ends included
+    nSteps = numpy.maximum(numpy.ceil(numpy.maximum(numpy.abs(dc), numpy.abs(dr))), 1).astype(numpy.int64)
+    seg = numpy.repeat(numpy.arange(len(labels)), nSteps + 1)
+    first = numpy.cumsum(nSteps + 1) - (nSteps + 1)
+    k = numpy.arange(len(seg)) - numpy.repeat(first, nSteps + 1)
+    t = k / nSteps[seg].astype(float)
+
+    col = numpy.floor(c0[seg] + dc[seg] * t).astype(numpy.int64)
+    row = numpy.floor(r0[seg] + dr[seg] * t).astype(numpy.int64)
+    inside = (row >= 0) & (row < grid.nrows) & (col >= 0) & (col < grid.ncols)
+
+    cells = row[inside] * grid.ncols + col[inside]
+    labels = labels[seg[inside]]
+
+    # unique (label, cell) pairs
+    key = labels * (grid.nrows * grid.ncols) + cells
+    key = numpy.unique(key)
+    return key // (grid.nrows * grid.ncols), key % (grid.nrows * grid.ncols)
+
+
+
+def polygon_mask(rings, grid):
+    # Cells whose centre falls inside a polygon (like PolygonToRaster CELL_CENTER or an
+    # analysis mask). rings: vertex sequences of one feature; interior rings are holes
+    # because crossings are counted even-odd along each row of cell centres.
+    mask = numpy.zeros((grid.nrows, grid.ncols), dtype=bool)
+    starts, ends = [], []
+    for ring in rings:
+        xy = numpy.asarray(ring, dtype=float).reshape(-1, 2)
+        if len(xy) < 3:
+            continue
+        if not numpy.array_equal(xy[0], xy[-1]):
+            xy = numpy.vstack([xy, xy[:1]])
+        starts.append(xy[:-1])
+        ends.append(xy[1:])
+    if not starts:
+        return mask
+
+    start = numpy.concatenate(starts)
+    end = numpy.concatenate(ends)
+    # edge ends in continuous cell coordinates; cell centres sit at row + 0.5
+    c0 = (start[:, 0] - grid.xmin) / grid.cellSize
+    r0 = (grid.ymax - start[:, 1]) / grid.cellSize
+    c1 = (end[:, 0] - grid.xmin) / grid.cellSize
+    r1 = (grid.ymax - end[:, 1]) / grid.cellSize
+
+    # rows whose centre line crosses each edge (half-open so shared vertices count once)
+    rowFirst = numpy.clip(numpy.ceil(numpy.minimum(r0, r1) - 0.5), 0, grid.nrows).astype(numpy.int64)
+    rowStop = numpy.clip(numpy.ceil(numpy.maximum(r0, r1) - 0.5), 0, grid.nrows).astype(numpy.int64)
+    nCross = numpy.maximum(rowStop - rowFirst, 0)
+    edge = numpy.repeat(numpy.arange(len(start)), nCross)
+    if len(edge) == 0:
+        return mask
+    first = numpy.cumsum(nCross) - nCross
+    row = rowFirst[edge] + numpy.arange(len(edge)) - numpy.repeat(first, nCross)
+    t = (row + 0.5 - r0[edge]) / (r1[edge] - r0[edge])
+    col = c0[edge] + t * (c1[edge] - c0[edge])
+
+    # pair crossings left to right along each row and fill the centres between them
+    order = numpy.lexsort((col, row))
+    row, col = row[order], col[order]
+    colStart = numpy.clip(numpy.ceil(col[0::2] - 0.5), 0, grid.ncols).astype(numpy.int64)
+    colStop = numpy.clip(numpy.ceil(col[1::2] - 0.5), 0, grid.ncols).astype(numpy.int64)
+    fill = numpy.zeros((grid.nrows, grid.ncols + 1), dtype=numpy.int32)
+    numpy.add.at(fill, (row[0::2], colStart), 1)
+    numpy.add.at(fill, (row[0::2], colStop), -1)
+    mask[:] = numpy.cumsum(fill, axis=1)[:, :-1] > 0
+    return mask
@@ -0,0 +1,99 @@
+# resultwriter.py
+# PURPOSE : To store cost path and major flow path group statistics as binary column
+#           batches partitioned by basin and assessment unit, with CSV export on demand
+# Inputs  : one structured array (or dict of columns) per table and assessment unit
+# OUTPUTS : tables/<table>/basin_id=<basin>/assess_id=<unit>.npz
+
+import csv
+import glob
+import os
+import numpy
+
+
+def batch_path(rootPath, table, basinID, assessID, part=None):
+    # a unit's batch, or one of its numbered parts when a unit is written in pieces
+    name = "assess_id={}".format(assessID) if part is None else "assess_id={}.part{:06d}".format(assessID, part)
+    return "{}/{}/basin_id={}/{}.npz".format(rootPath, table, basinID, name)
+
+
+def as_columns(records):
+    # dict of column arrays from a structured array or a dict
+    if isinstance(records, dict):
+        return dict((name, numpy.asarray(values)) for name, values in records.items())
+    return dict((name, numpy.asarray(records[name])) for name in records.dtype.names)
+
+
+def remove_batches(rootPath, table, basinID, assessID, keep=None):
+    # delete a unit's batch and its parts (all but keep)
+    folder = os.path.dirname(batch_path(rootPath, table, basinID, assessID))
+    stale = glob.glob("{}/assess_id={}.npz".format(folder, assessID)) + \
+        glob.glob("{}/assess_id={}.part*.npz".format(folder, assessID))
+    for path in stale:
+        if keep is None or os.path.normpath(path) != os.path.normpath(keep):
+            os.remove(path)
+
+
+def write_batch(rootPath, table, basinID, assessID, records, part=None):
+    # Write one unit's rows (or one part of them) as a batch of columns. A unit always
+    # replaces its own batches, so rerunning a unit never duplicates rows, and the rename
+    # makes a batch appear complete or not at all.
+    outPath = batch_path(rootPath, table, basinID, assessID, part)
+    folder = os.path.dirname(outPath)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    if not part: # the first (or only) batch of a unit drops whatever an earlier run wrote
+        remove_batches(rootPath, table, basinID, assessID, keep=outPath)
+    tmpPath = outPath + ".tmp"
+    with open(tmpPath, "wb") as f:
+        numpy.savez_compressed(f, **as_columns(records))
+    os.replace(tmpPath, outPath)
+    return outPath
+
+
+def batch_paths(rootPath, table, basinID=None):
+    # batches of one basin (or all basins), in basin then unit order
+    basinPattern = "*" if basinID is None else str(basinID)
+    return sorted(glob.glob("{}/{}/basin_id={}/assess_id=*.npz".format(rootPath, table, basinPattern)))
+
+
+def read_batch(path):
+    # columns of one batch plus basin_id and assess_id taken from its path
+    folder, name = os.path.split(path)
+    with numpy.load(path) as batch:
+        columns = dict((column, batch[column]) for column in batch.files)
+    rows = len(next(iter(columns.values()))) if columns else 0
+    columns["basin_id"] = numpy.repeat(os.path.basename(folder).split("=", 1)[1], rows)
+    columns["assess_id"] = numpy.repeat(name[:-len(".npz")].split("=", 1)[1].split(".part")[0], rows)
+    return columns
+
+
+def read_table(rootPath, table, basinID=None):
+    # one basin (or the whole run) as a dict of columns, without touching other basins
+    batches = [read_batch(path) for path in batch_paths(rootPath, table, basinID)]
+    if not batches:
+        return {}
+    return dict((column, numpy.concatenate([batch[column] for batch in batches])) for column in batches[0])
+
+
+def csv_values(column):
+    # column values for a CSV row, NoData (NaN) as an empty field like pandas to_csv
+    if column.dtype.kind == "f":
+        return ["" if value != value else value for value in column.tolist()]
+    return column.tolist()
+
+
+def export_csv(rootPath, table, outCSV, basinIDs=None, columns=None):
+    # stream batches into one CSV (basins in the given order), one batch in memory at a time
+    paths = []
+    for basinID in (basinIDs if basinIDs is not None else [None]):
+        paths += batch_paths(rootPath, table, basinID)
+    order = None
+    with open(outCSV, "w") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        for path in paths:
+            batch = read_batch(path)
+            if order is None:
+                order = ["basin_id", "assess_id"] + (columns or [c for c in batch if c not in ("basin_id", "assess_id")])
+                writer.writerow(order)
+            writer.writerows(zip(*[csv_values(batch[column]) for column in order]))
+    return outCSV
@@ -0,0 +1,117 @@
+# slope.py
+# PURPOSE : To calculate slope in degrees from a DEM window and reclassify it into the
+#           cost surface used by path distance, without writing intermediate rasters
+# Inputs  : DEM array (NoData as NaN), cell size, optional basin mask
+# OUTPUTS : slope array, class array (1..N, NaN = NoData) and the class breaks
+
+import numpy
+
+
+def slope_degrees(dem, cellSize, zFactor=1.0, mask=None):
+    # Horn's 3x3 method as used by Slope_sa with "DEGREE": NoData neighbours (and
+    # neighbours beyond the window edge) take the value of the centre cell, cells that
+    # are NoData themselves or outside the mask stay NoData.
+    dem = numpy.asarray(dem, dtype=numpy.float64) * zFactor
+    padded = numpy.pad(dem, 1, mode="constant", constant_values=numpy.nan)
+    nrows, ncols = dem.shape
+
+    def neighbour(dr, dc):
+        values = padded[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+        return numpy.where(numpy.isnan(values), dem, values)
+
+    a, b, c = neighbour(-1, -1), neighbour(-1, 0), neighbour(-1, 1)
+    d, f = neighbour(0, -1), neighbour(0, 1)
+    g, h, i = neighbour(1, -1), neighbour(1, 0), neighbour(1, 1)
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8.0 * cellSize)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8.0 * cellSize)
+    slope = numpy.degrees(numpy.arctan(numpy.hypot(dzdx, dzdy)))
+    if mask is not None:
+        slope[~numpy.asarray(mask, dtype=bool)] = numpy.nan
+    return slope
+
+
+def class_breaks(values, nClasses=10, method="EQUAL_INTERVAL"):
+    # upper class limits of nClasses classes over the data cells of values
+    data = values[numpy.isfinite(values)]
+    if len(data) == 0:
+        return numpy.zeros(0)
+    if method == "EQUAL_INTERVAL":
+        minValue, maxValue = data.min(), data.max()
+        classSize = (maxValue - minValue) / float(nClasses)
+        breaks = minValue + classSize * numpy.arange(1, nClasses + 1)
+        breaks[-1] = maxValue
+        return breaks
+    if method == "QUANTILE":
+        return numpy.percentile(data, 100.0 * numpy.arange(1, nClasses + 1) / nClasses)
+    raise ValueError("Unsupported classification method: {}".format(method))
+
+
+def streamed_class_breaks(chunks, nClasses=10, method="EQUAL_INTERVAL", bins=1024, maxGather=2 ** 20):
+    # class_breaks over data read in chunks (chunks() returns a fresh iterator of arrays
+    # each time it is called), for rasters too large to hold. Quantiles are exact, as
+    # numpy.percentile: the value range of every rank needed is narrowed by counts of the
+    # data below bin edges, one pass over the chunks per step, until the data of its bin
+    # is small enough to gather (or the bin cannot be split further).
+    count, low, high = 0, numpy.inf, -numpy.inf
+    for chunk in chunks():
+        data = chunk[numpy.isfinite(chunk)]
+        if len(data):
+            count, low, high = count + len(data), min(low, data.min()), max(high, data.max())
+    if count == 0:
+        return numpy.zeros(0)
+    if method == "EQUAL_INTERVAL":
+        return class_breaks(numpy.array([low, high]), nClasses, method)
+    if method != "QUANTILE":
+        raise ValueError("Unsupported classification method: {}".format(method))
+
+    position = (count - 1) * numpy.arange(1, nClasses + 1) / float(nClasses)
+    ranks = sorted(set(numpy.floor(position).astype(int).tolist() + numpy.ceil(position).astype(int).tolist()))
+    # rank: [lower edge, upper edge (exclusive), data count below the lower edge]
+    search = dict((rank, [low, numpy.nextafter(high, numpy.inf), 0]) for rank in ranks)
+    values = {}
+    while search:
+        edges = dict((rank, numpy.linspace(lo, hi, bins + 1)) for rank, (lo, hi, below) in search.items())
+        below = dict((rank, numpy.zeros(bins + 1, dtype=numpy.int64)) for rank in search)
+        for chunk in chunks():
+            data = numpy.sort(chunk[numpy.isfinite(chunk)])
+            for rank in search:
+                below[rank] += numpy.searchsorted(data, edges[rank], side="left")
+        gather = {}
+        for rank in list(search):
+            j = int(numpy.searchsorted(below[rank], rank, side="right")) - 1
+            lo, hi = edges[rank][j], edges[rank][j + 1]
+            inBin = below[rank][j + 1] - below[rank][j]
+            if inBin <= maxGather or numpy.nextafter(lo, numpy.inf) >= hi:
+                gather[rank] = (lo, hi, below[rank][j])
+                del search[rank]
+            else:
+                search[rank] = [lo, hi, below[rank][j]]
+        if gather:
+            found = dict((rank, []) for rank in gather)
+            for chunk in chunks():
+                for rank, (lo, hi, n) in gather.items():
+                    found[rank].append(chunk[(chunk >= lo) & (chunk < hi)])
+            for rank, (lo, hi, n) in gather.items():
+                values[rank] = numpy.sort(numpy.concatenate(found[rank]))[rank - n]
+
+    # linear interpolation between the ranks around each position, as numpy.percentile
+    lower = numpy.array([values[rank] for rank in numpy.floor(position).astype(int)])
+    upper = numpy.array([values[rank] for rank in numpy.ceil(position).astype(int)])
+    return lower + (upper - lower) * (position - numpy.floor(position))
+
+
+def reclassify(values, breaks):
+    # class k for values in (break k-1, break k]; the minimum falls in class 1
+    classes = numpy.full(values.shape, numpy.nan)
+    data = numpy.isfinite(values)
+    if len(breaks):
+        index = numpy.searchsorted(breaks, values[data], side="left")
+        classes[data] = numpy.minimum(index, len(breaks) - 1) + 1
+    return classes
+
+
+def slope_cost(dem, cellSize, nClasses=10, method="EQUAL_INTERVAL", mask=None):
+    # slope and its reclassified cost surface in one call
+    slope = slope_degrees(dem, cellSize, mask=mask)
+    breaks = class_breaks(slope, nClasses, method)
+    return slope, reclassify(slope, breaks), breaks
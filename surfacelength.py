@@ -0,0 +1,57 @@
+# surfacelength.py
+# PURPOSE : To calculate the surface (3D) length of every cost path from the flow tree,
+#           approximating AddSurfaceInformation_3d(..., "SURFACE_LENGTH", "BILINEAR") per polyline
+# Inputs  : parent index per cell from flowtree.backlink_parents, basin DEM window
+# OUTPUTS : 3D length of every backlink step; SLength of the path starting at every cell
+
+import numpy
+from flowtree import path_sum
+
+
+def corner_elevations(dem):
+    # Bilinear DEM value at every cell corner, (nrows + 1, ncols + 1): the mean of the
+    # (up to four) data cells around the corner; NaN where all of them are NoData
+    nrows, ncols = dem.shape
+    padded = numpy.full((nrows + 2, ncols + 2), numpy.nan)
+    padded[1:-1, 1:-1] = dem
+    quad = numpy.stack([padded[:-1, :-1], padded[:-1, 1:], padded[1:, :-1], padded[1:, 1:]])
+    count = numpy.isfinite(quad).sum(axis=0)
+    total = numpy.where(numpy.isfinite(quad), quad, 0.0).sum(axis=0)
+    return numpy.where(count > 0, total / numpy.maximum(count, 1), numpy.nan)
+
+
+def step_lengths(parent, dem, cellSize, zFactor=1.0):
+    # 3D length of the step from every cell centre to its parent's centre (0 for source
+    # cells and cells without a path). Straight steps are sampled at both centres, where
+    # the bilinear surface equals the cell values; diagonal steps also at the shared
+    # corner they cross. This approximates AddSurfaceInformation, which samples the
+    # polyline every cell size from its start, points that in general miss the corners.
+    nrows, ncols = dem.shape
+    z = numpy.asarray(dem, dtype=numpy.float64).ravel() * zFactor
+    length = numpy.zeros(len(parent))
+    cells = numpy.flatnonzero(parent >= 0)
+    to = parent[cells]
+    row, col = numpy.divmod(cells, ncols)
+    dr, dc = numpy.divmod(to, ncols)
+    dr, dc = dr - row, dc - col
+    diagonal = (dr != 0) & (dc != 0)
+
+    straight = ~diagonal
+    dz = z[to[straight]] - z[cells[straight]]
+    length[cells[straight]] = numpy.sqrt(cellSize * cellSize + dz * dz)
+
+    corner = corner_elevations(dem) * zFactor
+    d = cells[diagonal]
+    zc = corner[row[diagonal] + numpy.maximum(dr[diagonal], 0), col[diagonal] + numpy.maximum(dc[diagonal], 0)]
+    zc = numpy.where(numpy.isfinite(zc), zc, (z[d] + z[to[diagonal]]) / 2)
+    half = cellSize * cellSize / 2 # squared half diagonal
+    dz0 = zc - z[d]
+    dz1 = z[to[diagonal]] - zc
+    length[d] = numpy.sqrt(half + dz0 * dz0) + numpy.sqrt(half + dz1 * dz1)
+    return length
+
+
+def surface_length(parent, dem, cellSize, zFactor=1.0):
+    # SLength of the path starting at every cell: its step lengths summed down the tree,
+    # so each step is computed once however many paths share it
+    return path_sum(parent, step_lengths(parent, dem, cellSize, zFactor))
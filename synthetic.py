@@ -0,0 +1,105 @@
+# synthetic.py
+# PURPOSE : To generate synthetic basins (DEM, basin and assessment unit polygons, stream
+#           links) of any size, so the flow path engine can be run and timed without the
+#           national datasets or an ArcGIS licence
+# Inputs  : basin size in cells, number of assessment units, random seed
+# OUTPUTS : dict with the DEM array, its GridSpec, polygon rings and stream link vertices;
+#           dem.npy + basin.json when saved
+
+import json
+import math
+import os
+import numpy
+from rasterize import GridSpec, polyline_cells, rowcol_to_xy
+
+CELL_SIZE = 30.0
+ORIGIN = (500000.0, 6000000.0) # upper left corner (Albers metres)
+
+
+def basin_shape(nCells, aspect=1.0):
+    # rows and columns of a basin of about nCells cells (nrows / ncols = aspect)
+    ncols = max(int(round(math.sqrt(nCells / aspect))), 4)
+    nrows = max(int(round(nCells / float(ncols))), 4)
+    return nrows, ncols
+
+
+def fractal_surface(nrows, ncols, rng, beta=3.0):
+    # fractal (1/f^beta power spectrum) terrain scaled to 0..1
+    fy = numpy.fft.fftfreq(nrows)[:, None]
+    fx = numpy.fft.rfftfreq(ncols)[None, :]
+    f = numpy.sqrt(fx * fx + fy * fy)
+    f[0, 0] = 1.0
+    spectrum = (rng.normal(size=f.shape) + 1j * rng.normal(size=f.shape)) * f ** (-beta / 2.0)
+    spectrum[0, 0] = 0.0
+    z = numpy.fft.irfft2(spectrum, s=(nrows, ncols))
+    z -= z.min()
+    return z / max(z.max(), 1e-12)
+
+
+def channel_lines(nrows, ncols, rng, nTributaries):
+    # Stream links in (row, col) cell coordinates: a meandering trunk from the top to the
+    # bottom row and tributaries that run in from the sides and join it
+    rows = numpy.linspace(0, nrows - 1, max(nrows // 8, 2))
+    meander = numpy.cumsum(rng.normal(scale=ncols * 0.02, size=len(rows)))
+    trunkCols = numpy.clip(ncols / 2.0 + meander - meander.mean(), 1, ncols - 2)
+    lines = [list(zip(rows, trunkCols))]
+    for i in range(nTributaries):
+        row = rng.uniform(0, nrows - 1)
+        joinCol = numpy.interp(row, rows, trunkCols)
+        side = 0.0 if i % 2 == 0 else ncols - 1.0
+        startRow = numpy.clip(row - rng.uniform(0.05, 0.25) * nrows, 0, nrows - 1)
+        lines.append([(startRow, side), ((startRow + row) / 2.0, (side + joinCol) / 2.0), (row, joinCol)])
+    return lines
+
+
+def synthetic_basin(nCells, nUnits=1, seed=0, relief=500.0, channelDepth=10.0, nTributaries=None):
+    # A basin of about nCells cells: fractal terrain on a valley that falls towards the
+    # trunk stream and downstream (south), with the stream links carved in. The basin
+    # polygon covers the grid; assessment units are bands of rows, each crossed by the trunk.
+    rng = numpy.random.RandomState(seed)
+    nrows, ncols = basin_shape(nCells)
+    grid = GridSpec(ORIGIN[0], ORIGIN[1], CELL_SIZE, nrows, ncols)
+    if nTributaries is None:
+        nTributaries = max(2, min(nUnits * 2, nrows // 4))
+
+    lines = channel_lines(nrows, ncols, rng, nTributaries)
+    trunkRows, trunkCols = numpy.array(lines[0]).T
+    row = numpy.arange(nrows)[:, None]
+    col = numpy.arange(ncols)[None, :]
+    valley = numpy.abs(col - numpy.interp(numpy.arange(nrows), trunkRows, trunkCols)[:, None]) / float(ncols)
+    dem = relief * (0.5 * fractal_surface(nrows, ncols, rng) + valley + 0.5 * (1.0 - row / float(nrows)))
+
+    streams = []
+    for i, line in enumerate(lines):
+        xs, ys = rowcol_to_xy([r for r, c in line], [c for r, c in line], grid)
+        streams.append((i + 1, list(zip(xs.tolist(), ys.tolist()))))
+    channelCells = polyline_cells(streams, grid)[1]
+    dem.ravel()[channelCells] -= channelDepth
+
+    xmax, ymin = grid.xmin + ncols * CELL_SIZE, grid.ymax - nrows * CELL_SIZE
+    basin = [[(grid.xmin, grid.ymax), (xmax, grid.ymax), (xmax, ymin), (grid.xmin, ymin), (grid.xmin, grid.ymax)]]
+    units = []
+    bands = numpy.linspace(0, nrows, min(nUnits, nrows) + 1).round().astype(int)
+    for i in range(len(bands) - 1):
+        top, bottom = grid.ymax - bands[i] * CELL_SIZE, grid.ymax - bands[i + 1] * CELL_SIZE
+        units.append((i + 1, [[(grid.xmin, top), (xmax, top), (xmax, bottom), (grid.xmin, bottom), (grid.xmin, top)]]))
+    return {"dem": dem, "grid": grid, "basin": basin, "units": units, "streams": streams}
+
+
+def save_basin(basin, folder):
+    # dem.npy (memory-mappable, for demwindow.npy_dem) and the vector inputs as basin.json
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    numpy.save(folder + "/dem.npy", basin["dem"])
+    with open(folder + "/basin.json", "w") as f:
+        json.dump({"grid": list(basin["grid"]), "basin": basin["basin"], "units": basin["units"],
+                   "streams": basin["streams"]}, f)
+    return folder
+
+
+def load_basin(folder, mmap_mode="r"):
+    with open(folder + "/basin.json") as f:
+        basin = json.load(f)
+    basin["grid"] = GridSpec(*basin["grid"])
+    basin["dem"] = numpy.load(folder + "/dem.npy", mmap_mode=mmap_mode)
+    return basin
@@ -0,0 +1,87 @@
+# test_flowtree.py
+# PURPOSE : To check the flow tree kernels that replace CostPathAsPolyline,
+#           ZonalStatisticsAsTable and AddSurfaceInformation (path_sum, path_length,
+#           path_root, path_mean_std, step_lengths) against paths traced cell by cell
+# Run     : python -m pytest tests
+
+import math
+import numpy
+import pytest
+from pathdistance import path_distance
+from flowtree import NOPATH, ROOT, backlink_parents, path_length, path_root, path_sum
+from surfacelength import step_lengths
+from zonalstats import path_mean_std
+
+CELL_SIZE = 30.0
+
+
+def random_forest(seed, nrows=12, ncols=14):
+    # parents of a backlink forest from path distance over random costs: several sources,
+    # cells outside the mask without a path, and NaN cells in the value raster
+    rng = numpy.random.RandomState(seed)
+    surface = numpy.cumsum(rng.normal(scale=5.0, size=(nrows, ncols)), axis=0) + 50.0
+    cost = rng.randint(1, 11, size=(nrows, ncols)).astype(float)
+    source = rng.rand(nrows, ncols) < 0.05
+    source[0, 0] = True
+    mask = rng.rand(nrows, ncols) < 0.9
+    mask[0, 0] = True
+    dist, back = path_distance(source, cost, surface, CELL_SIZE, mask=mask)
+    values = rng.normal(size=nrows * ncols)
+    values[rng.rand(nrows * ncols) < 0.15] = numpy.nan
+    return backlink_parents(back), values
+
+
+def traced(parent, cell):
+    # the cells of one path, from the cell down to its source
+    cells = [cell]
+    while parent[cells[-1]] != ROOT:
+        cells.append(parent[cells[-1]])
+    return cells
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_path_kernels_match_traced_paths(seed):
+    parent, values = random_forest(seed)
+    assert (parent == NOPATH).any() and (parent == ROOT).sum() > 1
+    data = numpy.where(numpy.isfinite(values), values, 0.0)
+    sums, lengths, roots = path_sum(parent, data), path_length(parent), path_root(parent)
+    mean, std = path_mean_std(parent, values)
+    for cell in range(len(parent)):
+        if parent[cell] == NOPATH:
+            assert sums[cell] == 0.0 and lengths[cell] == 0 and roots[cell] == NOPATH
+            continue
+        cells = traced(parent, cell)
+        assert numpy.isclose(sums[cell], data[cells].sum())
+        assert lengths[cell] == len(cells)
+        assert roots[cell] == cells[-1]
+        pathValues = values[cells][numpy.isfinite(values[cells])]
+        if len(pathValues):
+            assert numpy.isclose(mean[cell], pathValues.mean())
+            assert numpy.isclose(std[cell], pathValues.std(), atol=1e-9)
+        else:
+            assert numpy.isnan(mean[cell])
+
+
+def test_step_lengths():
+    dem = numpy.array([[10.0, 12.0, 15.0],
+                       [11.0, 14.0, numpy.nan],
+                       [13.0, 16.0, 20.0]])
+    half = CELL_SIZE / math.sqrt(2.0)
+    # (0, 1) is the source: (0, 0) steps east to it, (1, 0) north to (0, 0) and (1, 1)
+    # north west to (0, 0) through the corner of (0, 0), (0, 1), (1, 0) and (1, 1)
+    parent = numpy.full(9, NOPATH)
+    parent[1], parent[0], parent[3], parent[4] = ROOT, 1, 0, 0
+    length = step_lengths(parent, dem, CELL_SIZE)
+    assert length[1] == 0.0 and (length[parent == NOPATH] == 0.0).all()
+    assert numpy.isclose(length[0], math.hypot(CELL_SIZE, 2.0))
+    assert numpy.isclose(length[3], math.hypot(CELL_SIZE, 1.0))
+    corner = (10.0 + 12.0 + 11.0 + 14.0) / 4
+    assert numpy.isclose(length[4], math.hypot(half, corner - 14.0) + math.hypot(half, 10.0 - corner))
+
+    # (1, 1) north east to (0, 2): the corner they cross touches the NoData cell (1, 2),
+    # which is left out of its bilinear value
+    parent = numpy.full(9, NOPATH)
+    parent[2], parent[4] = ROOT, 2
+    length = step_lengths(parent, dem, CELL_SIZE)
+    corner = (12.0 + 15.0 + 14.0) / 3
+    assert numpy.isclose(length[4], math.hypot(half, corner - 14.0) + math.hypot(half, 15.0 - corner))
@@ -0,0 +1,85 @@
+# test_pathdistance.py
+# PURPOSE : To check path_distance against an independent brute-force relaxation of the
+#           move costs on small synthetic DEMs (masks, NoData cost cells, every vertical
+#           factor keyword, the TABLE form) and the backlink codes
+# Run     : python -m pytest tests
+
+import numpy
+import pytest
+from pathdistance import BACKLINK_NODATA, MOVES, move_costs, path_distance
+
+CELL_SIZE = 30.0
+VERTICAL_FACTORS = ["BINARY 1 -30 30", "LINEAR 2 -90 90 -0.022222", "SYMMETRIC_LINEAR 1 -60 60 0.011111",
+                    [(-90, 3.0), (-10, 1.5), (0, 1.0), (10, 1.5), (90, 3.0)]]
+
+
+def relaxed_distance(source, edges):
+    # Bellman-Ford: relax every move of every cell until nothing changes
+    nrows, ncols = source.shape
+    dist = numpy.where(source, 0.0, numpy.inf)
+    changed = True
+    while changed:
+        changed = False
+        for k, (dr, dc) in enumerate(MOVES):
+            for row in range(nrows):
+                for col in range(ncols):
+                    r, c = row + dr, col + dc
+                    if 0 <= r < nrows and 0 <= c < ncols and dist[row, col] + edges[k, row, col] < dist[r, c] - 1e-9:
+                        dist[r, c] = dist[row, col] + edges[k, row, col]
+                        changed = True
+    return dist
+
+
+def random_case(seed, nrows=9, ncols=11):
+    rng = numpy.random.RandomState(seed)
+    surface = numpy.cumsum(rng.normal(scale=8.0, size=(nrows, ncols)), axis=1) + 100.0
+    cost = rng.randint(1, 11, size=(nrows, ncols)).astype(float)
+    cost[rng.rand(nrows, ncols) < 0.1] = numpy.nan
+    source = rng.rand(nrows, ncols) < 0.08
+    source[nrows // 2, ncols // 2] = True
+    mask = rng.rand(nrows, ncols) < 0.85
+    return source, cost, surface, mask
+
+
+def check_backlinks(dist, back, source, edges):
+    # every reached cell links to a neighbour whose distance plus the move gives its own
+    nrows, ncols = dist.shape
+    reached = numpy.isfinite(dist)
+    assert (back[~reached] == BACKLINK_NODATA).all()
+    assert (back[reached & (dist == 0.0) & source] == 0).all()
+    for row, col in zip(*numpy.nonzero(reached & (back > 0))):
+        dr, dc = MOVES[back[row, col] - 1]
+        r, c = row + dr, col + dc
+        k = MOVES.index((-dr, -dc)) # the move from the linked cell back to this one
+        assert numpy.isclose(dist[r, c] + edges[k, r, c], dist[row, col])
+
+
+@pytest.mark.parametrize("verticalFactor", VERTICAL_FACTORS)
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_relaxation(seed, verticalFactor):
+    source, cost, surface, mask = random_case(seed)
+    dist, back = path_distance(source, cost, surface, CELL_SIZE, verticalFactor, mask=mask)
+    edges = move_costs(cost, surface, CELL_SIZE, verticalFactor, mask=mask)
+    sources = source & mask & numpy.isfinite(cost)
+    expected = relaxed_distance(sources, edges)
+    assert numpy.array_equal(numpy.isfinite(dist), numpy.isfinite(expected))
+    assert numpy.allclose(dist[numpy.isfinite(dist)], expected[numpy.isfinite(expected)])
+    check_backlinks(dist, back, sources, edges)
+
+
+def test_nodata_and_masked_cells():
+    source, cost, surface, mask = random_case(7)
+    dist, back = path_distance(source, cost, surface, CELL_SIZE, "BINARY 1 -90 90", mask=mask)
+    blocked = ~mask | numpy.isnan(cost)
+    assert numpy.isnan(dist[blocked]).all()
+    assert (back[blocked] == BACKLINK_NODATA).all()
+
+
+def test_backlink_codes():
+    # one source in the middle of a flat, uniform grid: every neighbour links straight back
+    source = numpy.zeros((3, 3), dtype=bool)
+    source[1, 1] = True
+    dist, back = path_distance(source, numpy.ones((3, 3)), numpy.zeros((3, 3)), CELL_SIZE, "BINARY 1 -30 30")
+    assert back.tolist() == [[2, 3, 4], [1, 0, 5], [8, 7, 6]]
+    assert numpy.isclose(dist[1, 2], CELL_SIZE)
+    assert numpy.isclose(dist[0, 0], CELL_SIZE * numpy.sqrt(2.0))
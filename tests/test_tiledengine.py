@@ -0,0 +1,74 @@
+# test_tiledengine.py
+# PURPOSE : To check that a basin run in tiles (tiledengine) writes the tables and lines
+#           of the same basin run in memory, row for row, for both slope break methods,
+#           and that rerunning units into the same results folder never duplicates rows
+# Run     : python -m pytest tests
+
+import json
+import os
+import numpy
+import pytest
+import flowengine
+from localbackend import LocalBackend
+from resultwriter import read_table
+from synthetic import save_basin, synthetic_basin
+
+OUTPUTS = ["CostPath", "MajorFlowPathGroups"]
+TILED_BUDGET = 384 * 16 ** 2 # 16 x 16 cell tiles
+
+
+@pytest.fixture
+def basinFolder(tmp_path):
+    folder = str(tmp_path / "basin")
+    save_basin(synthetic_basin(3000, 2, 0), folder)
+    return folder
+
+
+def run(basinFolder, resultsPath, memoryBudget=None):
+    flowengine.flow_paths("g", LocalBackend(basinFolder), resultsPath, outputs=OUTPUTS, memoryBudget=memoryBudget)
+
+
+def assert_same_tables(pathA, pathB):
+    for table in flowengine.TABLES:
+        a, b = read_table(pathA + "/tables", table), read_table(pathB + "/tables", table)
+        assert sorted(a) == sorted(b)
+        for column in a:
+            if a[column].dtype.kind == "f":
+                numpy.testing.assert_allclose(a[column], b[column], rtol=0, atol=1e-8)
+            else:
+                numpy.testing.assert_array_equal(a[column], b[column])
+
+
+def features(path):
+    with open(path) as f:
+        return json.load(f)["features"]
+
+
+@pytest.mark.parametrize("method", ["EQUAL_INTERVAL", "QUANTILE"])
+def test_tiled_matches_in_memory(basinFolder, tmp_path, monkeypatch, method):
+    monkeypatch.setattr(flowengine, "SLOPE_BREAKS", method)
+    inMemory, tiled = str(tmp_path / "memory"), str(tmp_path / "tiled")
+    run(basinFolder, inMemory)
+    run(basinFolder, tiled, TILED_BUDGET)
+    assert_same_tables(inMemory, tiled)
+
+    lines = sorted(name for name in os.listdir(inMemory) if name.endswith(".geojson"))
+    assert len(lines) == 4 and lines == sorted(name for name in os.listdir(tiled) if name.endswith(".geojson"))
+    for name in lines:
+        a, b = features(inMemory + "/" + name), features(tiled + "/" + name)
+        assert len(a) == len(b)
+        for featureA, featureB in zip(a, b):
+            assert featureA["geometry"] == featureB["geometry"]
+            assert list(featureA["properties"]) == list(featureB["properties"])
+
+
+def test_rerun_replaces_unit_rows(basinFolder, tmp_path):
+    # the same units written in memory, then in tiles (table parts), then in memory again
+    # into one results folder, each time without the manifest that would skip them
+    reference, resultsPath = str(tmp_path / "reference"), str(tmp_path / "results")
+    run(basinFolder, reference)
+    for memoryBudget in [None, TILED_BUDGET, TILED_BUDGET, None]:
+        if os.path.exists(resultsPath + "/manifest/g.json"):
+            os.remove(resultsPath + "/manifest/g.json")
+        run(basinFolder, resultsPath, memoryBudget)
+        assert_same_tables(reference, resultsPath)
@@ -0,0 +1,514 @@
+# tiledengine.py
+# PURPOSE : To run the flow path analysis of basins too large for memory in square
+#           tiles: slope with a one-cell halo, path distance converged across tile
+#           borders by boundary exchange, and path sums stitched across tiles through
+#           global parent indices, with the basin-sized arrays memory-mapped on disk
+# Inputs  : basin features, the DEM source and the basin window, a memory budget
+# OUTPUTS : unit tables as column batches in parts of whole window rows, cost path lines
+
+import collections
+import math
+import os
+import shutil
+import numpy
+from numpy.lib.format import open_memmap
+from rasterize import GridSpec, bounding_window, polygon_mask, polyline_cells
+from pathstore import column_table, trace_paths
+from pathdistance import BACKLINK_NODATA, dijkstra, move_costs, passable
+from flowtree import NOPATH, backlink_parents
+from flowgroups import trace_chains
+from surfacelength import step_lengths
+from slope import reclassify, slope_degrees, streamed_class_breaks
+from manifest import content_hash
+from resultwriter import remove_batches, write_batch
+from zonalstats import sum_mean_std
+
+BYTES_PER_CELL = 384 # working memory per cell (about 330 measured at 10^6); move costs and the front dominate
+# the cost path store of a unit holds every path end to end: on average about
+# PATH_LENGTH_FACTOR * sqrt(cells) cells per path (0.17 measured at 10^5, 0.13 at 10^6)
+PATH_LENGTH_FACTOR = 0.2
+PATH_CELL_BYTES = 4 # one int32 cell index per path cell
+# group line chains are Python lists of cell indices, up to two entries per group cell
+GROUP_CELL_BYTES = 80
+HALO = 1 # cells around a tile core: the slope stencil and one path distance move
+# sums carried down every path: cell count, surface length, and count, sum and sum of
+# squares of the slope and DEM data cells (for the per-path mean and std)
+SUMS = ["LENGTH", "SLength", "SLOPE_N", "SLOPE_S", "SLOPE_SS", "DEM_N", "DEM_S", "DEM_SS"]
+# outputs a tiled basin can write besides its tables; the rasters need whole-unit arrays
+TILED_OUTPUTS = ["CostPath", "MajorFlowPathGroups"]
+NEIGHBOURS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def tile_size(memoryBudget, bytesPerCell=BYTES_PER_CELL):
+    # edge of the largest square tile core whose window (halo included) fits the budget
+    return max(int(math.sqrt(memoryBudget / float(bytesPerCell))) - 2 * HALO, 16)
+
+
+def in_memory_bytes(grid, outputs=(), bytesPerCell=BYTES_PER_CELL):
+    # expected peak of a basin run in memory: the working arrays, plus the path store the
+    # cost path lines are exported from
+    cells = grid.nrows * grid.ncols
+    pathCells = cells * PATH_LENGTH_FACTOR * math.sqrt(cells) if "CostPath" in outputs else 0
+    return cells * bytesPerCell + pathCells * PATH_CELL_BYTES
+
+
+def needs_tiles(grid, memoryBudget, outputs=(), bytesPerCell=BYTES_PER_CELL):
+    return in_memory_bytes(grid, outputs, bytesPerCell) > memoryBudget
+
+
+def read_window(array, r0, c0, nrows, ncols, fill):
+    # array[..., r0:r0 + nrows, c0:c0 + ncols] with the cells beyond the array set to fill
+    out = numpy.full(array.shape[:-2] + (nrows, ncols), fill, dtype=array.dtype)
+    ra, rb = max(r0, 0), min(r0 + nrows, array.shape[-2])
+    ca, cb = max(c0, 0), min(c0 + ncols, array.shape[-1])
+    if ra < rb and ca < cb:
+        out[..., ra - r0:rb - r0, ca - c0:cb - c0] = array[..., ra:rb, ca:cb]
+    return out
+
+
+def chain_sums(jump, ext, values):
+    # Pointer jumping over the path pieces inside one tile. jump: next cell in the tile
+    # (len(jump) where the path leaves the tile or ends); ext: global cell the path
+    # continues at outside the tile (-1 if it ends inside). Returns every cell's sums to
+    # the end of its piece, the ext of the piece and the last cell of the piece.
+    n = len(jump)
+    jump = numpy.append(jump, n)
+    ext = numpy.append(ext, -1)
+    end = numpy.arange(n + 1)
+    values = numpy.concatenate([values, numpy.zeros((len(values), 1))], axis=1)
+    while (jump[:n] != n).any():
+        active = jump != n
+        values = values + values[:, jump]
+        ext = numpy.where(active, ext[jump], ext)
+        end = numpy.where(active, end[jump], end)
+        jump = jump[jump]
+    return values[:, :n], ext[:n], end[:n]
+
+
+class TiledBasin(object):
+    # Basin level arrays (DEM window, slope, cost classes, pointid) and the per-unit state
+    # as memory-mapped scratch files, read and written one tile window at a time
+
+    def __init__(self, features, dem, row0, col0, grid, scratchPath, memoryBudget,
+                 nClasses=10, method="EQUAL_INTERVAL", profiler=None):
+        self.grid = grid
+        self.memoryBudget = memoryBudget
+        self.size = tile_size(memoryBudget)
+        self.tiles = [(r, c) for r in range(0, grid.nrows, self.size) for c in range(0, grid.ncols, self.size)]
+        self.scratchPath = scratchPath
+        if not os.path.exists(scratchPath):
+            os.makedirs(scratchPath)
+        shape = (grid.nrows, grid.ncols)
+        self.dem = self.scratch("dem", numpy.float64, shape)
+        self.slope = self.scratch("slope", numpy.float64, shape)
+        self.reclass = self.scratch("reclass", numpy.float32, shape)
+        self.pointid = self.scratch("pointid", numpy.int64, shape)
+        self.unit = self.scratch("unit", numpy.bool_, shape, False)
+        self.dist = self.scratch("dist", numpy.float64, shape, numpy.inf)
+        self.back = self.scratch("back", numpy.int8, shape, BACKLINK_NODATA)
+        self.parent = self.scratch("parent", numpy.int64, shape, NOPATH)
+        self.exit = self.scratch("exit", numpy.int64, shape, -1)
+        self.root = self.scratch("root", numpy.int64, shape, NOPATH)
+        self.inner = self.scratch("inner", numpy.bool_, shape, False) # cells a path passes through
+        self.covered = self.scratch("covered", numpy.bool_, shape, False) # cells on a group line
+        self.sums = self.scratch("sums", numpy.float64, (len(SUMS),) + shape, 0.0)
+        self.touched = set()
+
+        # DEM and slope tile by tile: the halo is read from the DEM source and is NoData
+        # beyond the basin window, as at the edge of the in-memory window. Keeps the data
+        # cell counts per row and tile column and a hash of the DEM window.
+        counts = numpy.zeros((grid.nrows, len(range(0, grid.ncols, self.size))), dtype=numpy.int64)
+        tileHashes = []
+        for r, c in self.tiles:
+            nr, nc = self.core_shape(r, c)
+            window = dem.read(row0 + r - HALO, col0 + c - HALO, nr + 2 * HALO, nc + 2 * HALO)
+            window[~self.inside(r, c)] = numpy.nan
+            basinMask = self.polygons(features["basin"], r, c)
+            slope = slope_degrees(window, grid.cellSize, mask=basinMask)[self.core(nr, nc)]
+            core = window[self.core(nr, nc)]
+            self.dem[r:r + nr, c:c + nc] = core
+            self.slope[r:r + nr, c:c + nc] = slope
+            counts[r:r + nr, c // self.size] = numpy.isfinite(core).sum(axis=1)
+            tileHashes.append(content_hash(core))
+        self.demHash = content_hash(tileHashes)
+        if profiler:
+            profiler.done("dem_window", cells=grid.nrows * grid.ncols, created=len(SUMS) + 12)
+
+        # class breaks from passes over the slope tiles (exact quantiles included), then
+        # the cost classes and the RasterToPoint pointid of every cell: the number of data
+        # cells up to it, from the counts of the rows and tiles before it
+        def slopeTiles():
+            for r, c in self.tiles:
+                nr, nc = self.core_shape(r, c)
+                yield self.slope[r:r + nr, c:c + nc]
+        self.breaks = streamed_class_breaks(slopeTiles, nClasses, method)
+        print('Upper class break values:')
+        print(self.breaks) # new upper class limits for each slope raster
+        flat = counts.ravel()
+        pointBase = (numpy.cumsum(flat) - flat).reshape(counts.shape)
+        for r, c in self.tiles:
+            nr, nc = self.core_shape(r, c)
+            self.reclass[r:r + nr, c:c + nc] = reclassify(self.slope[r:r + nr, c:c + nc], self.breaks)
+            data = numpy.isfinite(self.dem[r:r + nr, c:c + nc])
+            ids = pointBase[r:r + nr, c // self.size][:, None] + numpy.cumsum(data, axis=1)
+            self.pointid[r:r + nr, c:c + nc] = numpy.where(data, ids, 0)
+        if profiler:
+            profiler.done("slope_reclass", cells=grid.nrows * grid.ncols)
+
+        streamCells = numpy.unique(polyline_cells(features["streams"], grid)[1])
+        self.streamRows, self.streamCols = numpy.divmod(streamCells, grid.ncols)
+        if profiler:
+            profiler.done("stream_sources", cells=len(streamCells))
+
+    def scratch(self, name, dtype, shape, fill=None):
+        array = open_memmap(self.scratchPath + "/" + name + ".npy", "w+", dtype, shape)
+        if fill is not None:
+            array[...] = fill
+        return array
+
+    def close(self):
+        # drop the memory maps before their files are deleted
+        for name in ["dem", "slope", "reclass", "pointid", "unit", "dist", "back", "parent", "exit", "root", "inner",
+                     "covered", "sums"]:
+            setattr(self, name, None)
+        shutil.rmtree(self.scratchPath, ignore_errors=True)
+
+    def core_shape(self, r, c):
+        return min(self.size, self.grid.nrows - r), min(self.size, self.grid.ncols - c)
+
+    def core(self, nr, nc):
+        # the tile core within its window
+        return slice(HALO, HALO + nr), slice(HALO, HALO + nc)
+
+    def window_grid(self, r, c):
+        nr, nc = self.core_shape(r, c)
+        cellSize = self.grid.cellSize
+        return GridSpec(self.grid.xmin + (c - HALO) * cellSize, self.grid.ymax - (r - HALO) * cellSize,
+                        cellSize, nr + 2 * HALO, nc + 2 * HALO)
+
+    def inside(self, r, c):
+        # window cells that lie in the basin window
+        nr, nc = self.core_shape(r, c)
+        rows = numpy.arange(r - HALO, r + nr + HALO)
+        cols = numpy.arange(c - HALO, c + nc + HALO)
+        return ((rows >= 0) & (rows < self.grid.nrows))[:, None] & ((cols >= 0) & (cols < self.grid.ncols))[None, :]
+
+    def polygons(self, features, r, c):
+        # window cells inside any of the polygons (one list of rings per feature)
+        grid = self.window_grid(r, c)
+        mask = numpy.zeros((grid.nrows, grid.ncols), dtype=bool)
+        for rings in features:
+            mask |= polygon_mask(rings, grid)
+        return mask & self.inside(r, c)
+
+    def window(self, array, r, c, fill):
+        nr, nc = self.core_shape(r, c)
+        return read_window(array, r - HALO, c - HALO, nr + 2 * HALO, nc + 2 * HALO, fill)
+
+    def sources(self, r, c):
+        # stream link cells of the window
+        nr, nc = self.core_shape(r, c)
+        source = numpy.zeros((nr + 2 * HALO, nc + 2 * HALO), dtype=bool)
+        rows, cols = self.streamRows - (r - HALO), self.streamCols - (c - HALO)
+        keep = (rows >= 0) & (rows < nr + 2 * HALO) & (cols >= 0) & (cols < nc + 2 * HALO)
+        source[rows[keep], cols[keep]] = True
+        return source
+
+    def reset(self):
+        # clear the per-unit state of the tiles the previous unit wrote
+        for r, c in self.touched:
+            nr, nc = self.core_shape(r, c)
+            self.unit[r:r + nr, c:c + nc] = False
+            self.dist[r:r + nr, c:c + nc] = numpy.inf
+            self.back[r:r + nr, c:c + nc] = BACKLINK_NODATA
+            self.parent[r:r + nr, c:c + nc] = NOPATH
+            self.exit[r:r + nr, c:c + nc] = -1
+            self.root[r:r + nr, c:c + nc] = NOPATH
+            self.inner[r:r + nr, c:c + nc] = False
+            self.covered[r:r + nr, c:c + nc] = False
+            self.sums[:, r:r + nr, c:c + nc] = 0.0
+        self.touched = set()
+
+
+def unit_tiles(basin, rings, rows, cols):
+    # Tiles with cells of the unit, its mask written to the basin's unit array. Only the
+    # tiles overlapping the unit's bounding window (rows, cols) are rasterized.
+    tiles = []
+    for r, c in basin.tiles:
+        nr, nc = basin.core_shape(r, c)
+        if r + nr <= rows.start or r >= rows.stop or c + nc <= cols.start or c >= cols.stop:
+            continue
+        mask = basin.polygons(rings, r, c)[basin.core(nr, nc)]
+        if mask.any():
+            basin.unit[r:r + nr, c:c + nc] = mask
+            tiles.append((r, c))
+    basin.touched.update(tiles)
+    return tiles
+
+
+def tiled_path_distance(basin, tiles, verticalFactor):
+    # Path distance by boundary exchange: each tile runs Dijkstra over its window, seeded
+    # with its stream cells and with the distances already known in its halo; a tile
+    # whose border cells improve queues its neighbours again, until no tile changes.
+    # Returns the number of tile runs.
+    grid = basin.grid
+    inUnit = set(tiles)
+    queue = collections.deque(tiles)
+    queued = set(tiles)
+    runs = 0
+    while queue:
+        r, c = queue.popleft()
+        queued.discard((r, c))
+        nr, nc = basin.core_shape(r, c)
+        core = basin.core(nr, nc)
+        mask = basin.window(basin.unit, r, c, False)
+        cost = basin.window(basin.reclass, r, c, numpy.nan).astype(numpy.float64)
+        surface = basin.window(basin.dem, r, c, numpy.nan)
+        dist = basin.window(basin.dist, r, c, numpy.inf)
+        back = basin.window(basin.back, r, c, BACKLINK_NODATA)
+        source = basin.sources(r, c) & passable(cost, surface, None, mask)
+        dist[source] = 0.0
+        back[source] = 0
+        dist, back = dijkstra(move_costs(cost, surface, grid.cellSize, verticalFactor, mask=mask), dist, back)
+        runs += 1
+
+        old = basin.dist[r:r + nr, c:c + nc]
+        new = dist[core]
+        with numpy.errstate(invalid="ignore"):
+            improved = (numpy.isinf(old) & numpy.isfinite(new)) | (new < old - 1e-9 * numpy.abs(old))
+        if not improved.any():
+            continue
+        old[improved] = new[improved]
+        basin.back[r:r + nr, c:c + nc][improved] = back[core][improved]
+        if improved[0].any() or improved[-1].any() or improved[:, 0].any() or improved[:, -1].any():
+            for dr, dc in NEIGHBOURS:
+                neighbour = (r + dr * basin.size, c + dc * basin.size)
+                if neighbour in inUnit and neighbour not in queued:
+                    queue.append(neighbour)
+                    queued.add(neighbour)
+    return runs
+
+
+def tiled_path_sums(basin, tiles):
+    # Parent (global cell index), path root and the SUMS of every cell's path. Each tile
+    # sums the pieces of paths inside it; a piece that leaves the tile is completed from
+    # the cell it continues at (in the tile's halo) once that cell is complete, sweeping
+    # the tiles until every path is stitched.
+    grid = basin.grid
+    pending = []
+    for r, c in tiles:
+        nr, nc = basin.core_shape(r, c)
+        core = basin.core(nr, nc)
+        wr, wc = nr + 2 * HALO, nc + 2 * HALO
+        # core backlinks only: a halo cell's parent may lie beyond the window
+        back = numpy.full((wr, wc), BACKLINK_NODATA, dtype=numpy.int8)
+        back[core] = basin.back[r:r + nr, c:c + nc]
+        local = backlink_parents(back)
+        surface = basin.window(basin.dem, r, c, numpy.nan)
+        steps = step_lengths(local, surface, grid.cellSize).reshape(wr, wc)[core].ravel()
+        local = local.reshape(wr, wc)[core].ravel()
+
+        hasParent = local >= 0
+        pr, pc = numpy.divmod(numpy.where(hasParent, local, 0), wc)
+        parent = numpy.where(hasParent, (r - HALO + pr) * grid.ncols + (c - HALO + pc), local)
+        inCore = hasParent & (pr >= HALO) & (pr < HALO + nr) & (pc >= HALO) & (pc < HALO + nc)
+        n = nr * nc
+        jump = numpy.where(inCore, (pr - HALO) * nc + (pc - HALO), n)
+        ext = numpy.where(hasParent & ~inCore, parent, -1)
+
+        onPath = parent != NOPATH
+        slope = basin.slope[r:r + nr, c:c + nc].ravel()
+        dem = basin.dem[r:r + nr, c:c + nc].ravel()
+        values = [numpy.ones(n), steps]
+        for raster in [slope, dem]:
+            data = numpy.isfinite(raster)
+            v = numpy.where(data, raster, 0.0)
+            values += [data.astype(numpy.float64), v, v * v]
+        values = numpy.where(onPath, numpy.array(values), 0.0)
+        sums, ext, end = chain_sums(jump, ext, values)
+
+        er, ec = numpy.divmod(end, nc)
+        root = numpy.where(ext < 0, (r + er) * grid.ncols + (c + ec), -1)
+        basin.parent[r:r + nr, c:c + nc] = parent.reshape(nr, nc)
+        basin.sums[:, r:r + nr, c:c + nc] = sums.reshape(len(SUMS), nr, nc)
+        basin.exit[r:r + nr, c:c + nc] = ext.reshape(nr, nc)
+        basin.root[r:r + nr, c:c + nc] = numpy.where(onPath, root, NOPATH).reshape(nr, nc)
+        if (ext >= 0).any():
+            pending.append((r, c))
+
+    sweeps = 0
+    while pending:
+        sweeps += 1
+        stillPending = []
+        progress = False
+        for r, c in pending:
+            nr, nc = basin.core_shape(r, c)
+            exits = basin.exit[r:r + nr, c:c + nc].ravel()
+            cells = numpy.flatnonzero(exits >= 0)
+            er, ec = numpy.divmod(exits[cells], grid.ncols)
+            lr, lc = er - (r - HALO), ec - (c - HALO)
+            complete = basin.window(basin.exit, r, c, -1)[lr, lc] < 0
+            done, lr, lc = cells[complete], lr[complete], lc[complete]
+            if len(done):
+                progress = True
+                sums = basin.sums[:, r:r + nr, c:c + nc].reshape(len(SUMS), -1)
+                sums[:, done] += basin.window(basin.sums, r, c, 0.0)[:, lr, lc]
+                basin.sums[:, r:r + nr, c:c + nc] = sums.reshape(len(SUMS), nr, nc)
+                roots = basin.root[r:r + nr, c:c + nc].ravel()
+                roots[done] = basin.window(basin.root, r, c, NOPATH)[lr, lc]
+                basin.root[r:r + nr, c:c + nc] = roots.reshape(nr, nc)
+                exits[done] = -1
+                basin.exit[r:r + nr, c:c + nc] = exits.reshape(nr, nc)
+            if len(done) < len(cells):
+                stillPending.append((r, c))
+        if not progress:
+            raise RuntimeError("Flow paths could not be stitched across tiles")
+        pending = stillPending
+    return sweeps
+
+
+def group_sums(labels, values, nGroups):
+    # count, sum and sum of squares of values per label
+    return numpy.array([numpy.bincount(labels, minlength=nGroups),
+                        numpy.bincount(labels, values, nGroups),
+                        numpy.bincount(labels, values * values, nGroups)])
+
+
+def row_chunks(rows, cols, cells):
+    # the window (rows, cols) in chunks of whole window rows of about cells cells, so
+    # cells taken chunk by chunk come in basin cell order
+    step = max(1, int(cells) // max(cols.stop - cols.start, 1))
+    for start in range(rows.start, rows.stop, step):
+        yield slice(start, min(start + step, rows.stop))
+
+
+def chunk_paths(basin, rows, cols, groupEnds):
+    # Start cells (basin cell index) of the cost paths in a chunk of the unit window, in
+    # cell order, with their SUMS and the columns of flowengine.run_unit in its order
+    parent = basin.parent[rows, cols]
+    local = numpy.flatnonzero(parent.ravel() >= 0)
+    lr, lc = numpy.divmod(local, parent.shape[1])
+    starts = (rows.start + lr) * basin.grid.ncols + cols.start + lc
+    sums = basin.sums[:, rows, cols].reshape(len(SUMS), -1)[:, local]
+    columns = collections.OrderedDict()
+    columns["DestID"] = basin.pointid[rows, cols].ravel()[local]
+    columns["PathCost"] = basin.dist[rows, cols].ravel()[local]
+    columns["MFPGID"] = numpy.searchsorted(groupEnds, basin.root[rows, cols].ravel()[local])
+    columns["SLength"] = sums[SUMS.index("SLength")]
+    for k, prefix in [(2, "SLOPE"), (5, "DEM")]:
+        columns[prefix + "_M"], columns[prefix + "_SD"] = sum_mean_std(sums[k], sums[k + 1], sums[k + 2])
+    return starts, sums, columns
+
+
+def cost_path_batches(basin, rows, cols, groupEnds, meanLength):
+    # the unit's cost paths as path stores chunk by chunk, in the order of the table rows,
+    # each chunk's paths (meanLength cells on average) within the memory budget
+    parent = basin.parent.reshape(-1)
+    for chunk in row_chunks(rows, cols, basin.memoryBudget / (PATH_CELL_BYTES * max(meanLength, 1.0))):
+        starts, sums, columns = chunk_paths(basin, chunk, cols, groupEnds)
+        yield trace_paths(parent, starts, columns, sums[SUMS.index("LENGTH")].astype(numpy.int64))
+
+
+def group_part_batches(basin, rows, cols, groupEnds, groupCells):
+    # (MFPGID, cell chains) of every group in MFPGID order, the chains of
+    # flowgroups.group_parts: leaves are taken chunk by chunk in cell order and traced
+    # through the parent scratch array, for one range of groups at a time whose chains fit
+    # the memory budget (chains of different groups never meet)
+    for chunk in row_chunks(rows, cols, basin.size ** 2):
+        parent = basin.parent[chunk, cols]
+        basin.inner.reshape(-1)[parent[parent >= 0]] = True
+    parentView = memoryview(basin.parent.reshape(-1))
+    coveredView = memoryview(basin.covered.reshape(-1))
+    batch = numpy.cumsum(groupCells) * GROUP_CELL_BYTES // basin.memoryBudget
+    starts = numpy.flatnonzero(numpy.diff(batch, prepend=-1))
+    for first, last in zip(starts.tolist(), starts[1:].tolist() + [len(groupEnds)]):
+        parts = {}
+        for chunk in row_chunks(rows, cols, basin.size ** 2):
+            parent = basin.parent[chunk, cols]
+            local = numpy.flatnonzero(((parent >= 0) & ~basin.inner[chunk, cols]).ravel())
+            lr, lc = numpy.divmod(local, parent.shape[1])
+            leaves = (chunk.start + lr) * basin.grid.ncols + cols.start + lc
+            groups = numpy.searchsorted(groupEnds, basin.root[chunk, cols].ravel()[local])
+            keep = (groups >= first) & (groups < last)
+            trace_chains(leaves[keep].tolist(), groups[keep].tolist(), parentView, coveredView, parts)
+        for group in sorted(parts):
+            yield group, parts[group]
+
+
+def run_unit(GRID, assessID, rings, basin, backend, resultsPath, outputs, verticalFactor, profiler):
+    # One assessment unit of a tiled basin from path distance to its tables, the same
+    # tables (rows and FID in basin cell order) flowengine.run_unit writes, in parts of
+    # whole window rows; cost path and group lines are traced through the parent scratch
+    # array one part at a time. Returns the paths written.
+    grid = basin.grid
+    basin.reset()
+    rows, cols, unitGrid = bounding_window([ring for featureRings in rings for ring in featureRings], grid)
+    tiles = unit_tiles(basin, rings, rows, cols)
+    runs = tiled_path_distance(basin, tiles, verticalFactor)
+    profiler.done("path_distance", cells=len(tiles) * basin.size ** 2, tiles=len(tiles), tile_runs=runs)
+    sweeps = tiled_path_sums(basin, tiles)
+    profiler.done("flow_tree", tiles=len(tiles), sweeps=sweeps)
+
+    # MAJOR FLOW PATH GROUPS: keyed on the end cell of the paths, numbered in cell order
+    roots = [numpy.zeros(0, dtype=numpy.int64)]
+    for r, c in tiles:
+        nr, nc = basin.core_shape(r, c)
+        root = basin.root[r:r + nr, c:c + nc]
+        roots.append(numpy.unique(root[basin.parent[r:r + nr, c:c + nc] >= 0]))
+    groupEnds = numpy.unique(numpy.concatenate(roots))
+
+    # cost path table one part per chunk; group cells accumulate count, sum and sum of
+    # squares of slope and DEM, and the surface lengths of the group's paths
+    fields = ["PathCost", "DestID", "SLength", "MFPGID", "SLOPE_M", "SLOPE_SD", "DEM_M", "DEM_SD"]
+    groupSums = numpy.zeros((8, len(groupEnds)))
+    tablesPath = resultsPath + "/tables"
+    remove_batches(tablesPath, "CostPath_ZonalStats", GRID, assessID) # parts of an earlier run
+    written = []
+    nPaths = 0
+    pathCells = 0
+    for chunk in row_chunks(rows, cols, basin.size ** 2):
+        starts, sums, columns = chunk_paths(basin, chunk, cols, groupEnds)
+        table = column_table(columns, fields, "FID")
+        table["FID"] += nPaths
+        written.append(write_batch(tablesPath, "CostPath_ZonalStats", GRID, assessID, table, part=len(written) + 1))
+        nPaths += len(table)
+        pathCells += sums[SUMS.index("LENGTH")].sum()
+
+        mfpgID = columns["MFPGID"]
+        for k, raster in enumerate([basin.slope, basin.dem]):
+            values = raster.reshape(-1)[starts]
+            data = numpy.isfinite(values)
+            groupSums[3 * k:3 * k + 3] += group_sums(mfpgID[data], values[data], len(groupEnds))
+        groupSums[6] += numpy.bincount(mfpgID, columns["SLength"], len(groupEnds))
+        groupSums[7] += numpy.bincount(mfpgID, minlength=len(groupEnds))
+    profiler.done("tables", features=nPaths, created=len(written))
+
+    # the end cells belong to their groups as well
+    for k, raster in enumerate([basin.slope, basin.dem]):
+        values = raster.reshape(-1)[groupEnds]
+        data = numpy.isfinite(values)
+        groupSums[3 * k:3 * k + 3] += group_sums(numpy.flatnonzero(data), values[data], len(groupEnds))
+    keep = (groupSums[0] > 0) & (groupSums[3] > 0)
+    nparrMFPG = numpy.zeros(int(keep.sum()), dtype=[("MFPGID", numpy.int64), ("SLOPE_M", numpy.float64),
+                                                    ("SLOPE_SD", numpy.float64), ("DEM_M", numpy.float64),
+                                                    ("DEM_SD", numpy.float64), ("SLength", numpy.float64)])
+    nparrMFPG["MFPGID"] = numpy.flatnonzero(keep)
+    for k, prefix in [(0, "SLOPE"), (3, "DEM")]:
+        nparrMFPG[prefix + "_M"], nparrMFPG[prefix + "_SD"] = sum_mean_std(*groupSums[k:k + 3, keep])
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        nparrMFPG["SLength"] = groupSums[6, keep] / groupSums[7, keep]
+    written.append(write_batch(tablesPath, "MajorFlowPathGroup_ZonalStats", GRID, assessID, nparrMFPG))
+    profiler.done("zonal_stats", features=nPaths + len(nparrMFPG), created=1)
+
+    exported = len(written)
+    if "CostPath" in outputs:
+        written.append(backend.write_cost_paths(resultsPath + "/CostPath_" + assessID,
+                                                cost_path_batches(basin, rows, cols, groupEnds,
+                                                                  pathCells / max(nPaths, 1)), grid))
+    if "MajorFlowPathGroups" in outputs:
+        groups = group_part_batches(basin, rows, cols, groupEnds, groupSums[7] + 1)
+        written.append(backend.write_flow_path_groups(resultsPath + "/MajorFlowPathGroups_assess_" + assessID,
+                                                      groups, grid, nparrMFPG))
+    profiler.done("export_paths", features=nPaths + len(groupEnds), created=len(written) - exported)
+    return written
+
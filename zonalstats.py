@@ -0,0 +1,87 @@
+# zonalstats.py
+# PURPOSE : To calculate mean and standard deviation of basin rasters for every
+#           zone (cost path, major flow path group) in one grouped reduction
+# Inputs  : (label, cell) pairs from rasterize.polyline_cells, basin raster arrays
+# OUTPUTS : structured arrays ready for arcpy.da.ExtendTable / pandas
+
+import numpy
+from flowtree import NOPATH, path_sum
+
+
+def zonal_mean_std(labels, cells, values):
+    # Equivalent to ZonalStatisticsAsTable(..., "DATA", "MEAN_STD") for all zones at
+    # once: NoData (NaN) cells are ignored, zones without data cells are dropped and
+    # STD is the population standard deviation.
+    v = numpy.asarray(values, dtype=numpy.float64).ravel()[cells]
+    keep = numpy.isfinite(v)
+    v = v[keep]
+    zones, inverse = numpy.unique(numpy.asarray(labels)[keep], return_inverse=True)
+    count = numpy.bincount(inverse, minlength=len(zones)).astype(numpy.float64)
+    mean = numpy.bincount(inverse, weights=v, minlength=len(zones)) / count
+    dev = v - mean[inverse]
+    std = numpy.sqrt(numpy.bincount(inverse, weights=dev * dev, minlength=len(zones)) / count)
+    return zones, mean, std
+
+
+def sum_mean_std(n, s, ss):
+    # mean and population std from count, sum and sum of squares (NaN where n is 0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = s / n
+        return mean, numpy.sqrt(numpy.maximum(ss / n - mean * mean, 0.0))
+
+
+def path_mean_std(parent, values):
+    # Mean and population std of a raster over the cells of every path of the flow tree,
+    # NoData (NaN) ignored, from count, sum and sum of squares summed down the tree: no
+    # path is ever expanded into its cells. Values are shifted by their mean first so the
+    # sums of squares keep their precision.
+    v = numpy.asarray(values, dtype=numpy.float64).ravel()
+    data = numpy.isfinite(v) & (parent != NOPATH)
+    shift = v[data].mean() if data.any() else 0.0
+    v = numpy.where(data, v - shift, 0.0)
+    mean, std = sum_mean_std(path_sum(parent, data), path_sum(parent, v), path_sum(parent, v * v))
+    return mean + shift, std
+
+
+def zonal_table(labels, cells, rasters, idField):
+    # rasters: list of (prefix, array); adds <prefix>_M and <prefix>_SD per raster.
+    # Only zones with data in every raster are kept so all columns line up.
+    results = [zonal_mean_std(labels, cells, array) for prefix, array in rasters]
+    zones = results[0][0]
+    for result in results[1:]:
+        zones = numpy.intersect1d(zones, result[0])
+
+    dtype = [(idField, numpy.int64)]
+    for prefix, array in rasters:
+        dtype += [(prefix + "_M", numpy.float64), (prefix + "_SD", numpy.float64)]
+    table = numpy.zeros(len(zones), dtype=dtype)
+    table[idField] = zones
+    for (prefix, array), (resultZones, mean, std) in zip(rasters, results):
+        index = numpy.searchsorted(resultZones, zones)
+        table[prefix + "_M"] = mean[index]
+        table[prefix + "_SD"] = std[index]
+    return table
+
+
+def group_mean(labels, values):
+    # mean of values per label with NaN ignored, like pandas groupby(label).mean()
+    values = numpy.asarray(values, dtype=numpy.float64)
+    keep = numpy.isfinite(values)
+    zones, inverse = numpy.unique(numpy.asarray(labels)[keep], return_inverse=True)
+    count = numpy.bincount(inverse, minlength=len(zones))
+    return zones, numpy.bincount(inverse, weights=values[keep], minlength=len(zones)) / count
+
+
+def join_column(table, idField, name, zones, values):
+    # table with one more float column joined on idField (NaN where a zone has no value),
+    # the in-memory equivalent of JoinField
+    dtype = table.dtype.descr + [(name, numpy.float64)]
+    joined = numpy.zeros(len(table), dtype=dtype)
+    for field in table.dtype.names:
+        joined[field] = table[field]
+    joined[name] = numpy.nan
+    index = numpy.searchsorted(zones, table[idField])
+    found = index < len(zones)
+    found[found] = zones[index[found]] == table[idField][found]
+    joined[name][found] = numpy.asarray(values)[index[found]]
+    return joined